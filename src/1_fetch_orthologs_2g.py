@@ -2,15 +2,84 @@
 import requests
 import sys
 import time
-import pandas as pd
 import os
+import csv
+import asyncio
+import threading
+import json
+import sqlite3
+import random
+import codecs
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from alignment import file_digest
 
 # --- CONFIGURATION ---
-SERVER = "https://rest.ensembl.org"
-HEADERS = {"Content-Type": "application/json"}
+# ENSEMBL_REST_SERVER lets the fetcher run against a local mock server.
+SERVER = os.environ.get("ENSEMBL_REST_SERVER", "https://rest.ensembl.org")
+HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
 OUTPUT_DIR = "Downloads"
 UNIQUE_LIST_FILENAME = "unique_gene_list.txt"
 
+# --- BACKEND ---
+# "rest":  the Ensembl REST API.
+# "local": Ensembl Compara homology TSV dumps plus CDS/peptide FASTA files on
+#          disk (no network). They are indexed once into LOCAL_INDEX_FILE.
+BACKEND = os.environ.get("FETCH_BACKEND", "rest")
+LOCAL_HOMOLOGY_FILES = []   # e.g. ["Compara.113.protein_default.homologies.tsv"]
+LOCAL_CDS_FILES = []        # e.g. glob.glob("mirror/*.cds.all.fa"), human included for symbols
+LOCAL_PEP_FILES = []        # e.g. glob.glob("mirror/*.pep.all.fa"), headers give protein -> transcript
+# The dumps have no taxonomy_level column; for a human source gene it only
+# depends on the target species, so it is read from a species<TAB>level file.
+LOCAL_SPECIES_TAXONOMY_FILE = None
+LOCAL_INDEX_FILE = "local_mirror_index.sqlite"
+
+# --- DOWNLOAD ENGINE ---
+# "serial": one gene and one request at a time (original behaviour).
+# "async":  many genes and orthologs in flight at once, sharing one rate budget.
+FETCH_MODE = os.environ.get("FETCH_MODE", "serial")
+CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", 8))  # Requests/genes in flight (async mode)
+MAX_REQUESTS_PER_SECOND = 15  # Ensembl allows 15 requests/second per client
+
+# --- RETRIES ---
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0         # Seconds; doubled each attempt, with full jitter
+BACKOFF_MAX = 60.0
+RATE_LIMIT_LOW_WATER = 20  # Below this many X-RateLimit-Remaining, spread out requests
+
+# --- BATCHED LOOKUPS ---
+# Resolve gene symbols, protein -> transcript and transcript -> CDS with POST
+# batches instead of one GET per ID.
+BATCH_LOOKUPS = True
+LOOKUP_BATCH_SIZE = 1000   # POST /lookup/id maximum
+SEQUENCE_BATCH_SIZE = 50   # POST /sequence/id maximum
+
+# --- HOMOLOGY MODE ---
+# "condensed": homology IDs only, CDS resolved per protein (original behaviour).
+# "full":      one /homology request per gene that also carries every target's
+#              CDS (sequence=cds, aligned=0); only transcript IDs are looked up.
+HOMOLOGY_MODE = "condensed"
+
+# --- RESPONSE CACHE ---
+# Successful responses are kept on disk and reused on reruns until Ensembl
+# publishes a new release. Set CACHE_FILE = None to disable.
+CACHE_FILE = os.path.join(OUTPUT_DIR, "ensembl_cache.sqlite")
+CACHE_MAX_MB = 1024
+
+# --- PROTEIN MEMO ---
+# Paralogous source genes share fish orthologs; each protein is resolved once
+# per run. Entries beyond PROTEIN_MEMO_SIZE spill to PROTEIN_MEMO_SPILL_FILE
+# (None = just forget them).
+PROTEIN_MEMO_SIZE = 50000
+PROTEIN_MEMO_SPILL_FILE = None  # e.g. os.path.join(OUTPUT_DIR, "protein_memo.sqlite")
+
+# --- RUN JOURNAL ---
+# Records per-gene progress so an interrupted run picks up where it stopped.
+JOURNAL_FILE = os.path.join(OUTPUT_DIR, "fetch_journal.jsonl")
+
 # --- TAXONOMY LEVEL FILTER ---
 # These are the ancestral nodes that contain fishes but exclude Tetrapods (Mammals/Birds).
 FISH_TAXONOMY_LEVELS = {
@@ -21,44 +90,331 @@ FISH_TAXONOMY_LEVELS = {
     "Actinopterygii"
 }
 
-def fetch_url(endpoint, params=None):
+# --- SERVER-SIDE TAXON FILTER ---
+# Every non-tetrapod vertebrate clade (NCBI taxon ID) and the node where it
+# splits from human, i.e. the taxonomy_level Ensembl reports for it.
+FISH_CLADES = {
+    7898:    ("Actinopterygii (ray-finned fishes)",        "Euteleostomi"),
+    118072:  ("Coelacanthimorpha (coelacanths)",           "Sarcopterygii"),
+    7878:    ("Dipnomorpha (lungfishes)",                  "Sarcopterygii"),
+    7777:    ("Chondrichthyes (sharks, rays, chimaeras)",  "Gnathostomata"),
+    1476529: ("Cyclostomata (lampreys, hagfishes)",        "Vertebrata"),
+}
+# Only ask /homology for targets in these clades and/or species, so the ~300
+# non-fish species never leave the server. The taxonomy_level filter above is
+# still applied to what comes back. Empty lists = no server-side filtering.
+# A non-empty TARGET_TAXA must cover every FISH_CLADES entry whose node is in
+# FISH_TAXONOMY_LEVELS (checked at startup), or those orthologs are lost silently.
+TARGET_TAXA = [taxon for taxon, (_, level) in FISH_CLADES.items() if level in FISH_TAXONOMY_LEVELS]
+TARGET_SPECIES = []  # e.g. ["danio_rerio", "latimeria_chalumnae"]
+
+class RateLimiter:
     """
-    Fetches data with robust retry logic for rate limits (HTTP 429).
+    Spaces out requests so the whole run stays under one requests-per-second
+    budget, no matter how many threads are fetching. A 429 pauses everyone.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        """Blocks until this caller's slot in the shared budget comes up."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Pushes the next free slot back (used for Retry-After)."""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+    def observe(self, headers):
+        """
+        Reads Ensembl's X-RateLimit-Remaining / X-RateLimit-Reset headers.
+        When the window is nearly spent, the remaining requests are spread
+        over the time left so we slow down before the server sends a 429.
+        """
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        if remaining <= RATE_LIMIT_LOW_WATER:
+            self.pause(reset / max(remaining, 1))
+
+RATE_LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+class LatencyStats:
+    """Per-endpoint request latency histograms (seconds)."""
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, float('inf')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+
+    @staticmethod
+    def endpoint_key(endpoint):
+        # "/homology/id/human/ENSG..." -> "/homology/id"
+        return "/".join(endpoint.split("/")[:3])
+
+    def record(self, endpoint, seconds):
+        key = self.endpoint_key(endpoint)
+        with self.lock:
+            counts = self.histograms.setdefault(key, [0] * len(self.BUCKETS))
+            for i, edge in enumerate(self.BUCKETS):
+                if seconds <= edge:
+                    counts[i] += 1
+                    break
+            self.totals[key] = self.totals.get(key, 0.0) + seconds
+
+    def report(self):
+        if not self.histograms:
+            return
+        labels = [f"<={b:g}s" for b in self.BUCKETS[:-1]] + [f">{self.BUCKETS[-2]:g}s"]
+        print("\nRequest latency by endpoint:")
+        print(f"  {'endpoint':<22}{'n':>7}{'mean':>8}  " + " ".join(f"{l:>7}" for l in labels))
+        for key in sorted(self.histograms):
+            counts = self.histograms[key]
+            n = sum(counts)
+            mean = self.totals[key] / n
+            print(f"  {key:<22}{n:>7}{mean:>7.2f}s  " + " ".join(f"{c:>7}" for c in counts))
+
+LATENCY = LatencyStats()
+
+def make_session(pool_size):
+    """Keep-alive session whose connection pool can serve every worker thread."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+SESSION = make_session(max(CONCURRENCY, 10))
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter: uniform(0, base * 2^attempt), capped."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+class ResponseCache:
+    """
+    SQLite store of JSON responses keyed by endpoint + params (+ POST body).
+    Tagged with the Ensembl release; least recently used rows are evicted
+    once the payloads exceed max_bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, payload TEXT, size INTEGER, last_used REAL)"
+        )
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(endpoint, params=None, data=None):
+        return json.dumps([endpoint, params or {}, data], sort_keys=True)
+
+    def set_release(self, release):
+        """Drops every cached response if `release` differs from the stored one."""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'release'").fetchone()
+            if row and row[0] == str(release):
+                return False
+            self.db.execute("DELETE FROM responses")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('release', ?)", (str(release),))
+            self.total_bytes = 0
+            return row is not None
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT payload FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        payload = json.dumps(value)
+        with self.lock:
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, payload, len(payload), time.time()),
+            )
+            self.total_bytes += len(payload) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target_bytes):
+        """Deletes least recently used rows until the cache fits in target_bytes."""
+        rows = self.db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        self.db.execute("BEGIN")
+        for key, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+RESPONSE_CACHE = None  # Opened in main() by open_response_cache()
+
+class RequestFailed(Exception):
+    """
+    send_request() gave up after MAX_RETRIES attempts (network error, 429, 5xx).
+    Unlike a 4xx answer (None: the ID is unknown) this is worth retrying later.
+    """
+
+def send_request(endpoint, params=None, data=None, stream=False):
+    """
+    Sends one GET (or JSON POST if `data` is given) over the pooled SESSION with
+    robust retry logic: Retry-After on HTTP 429, jittered exponential backoff
+    on network errors and 5xx. Every attempt draws from the shared
+    RATE_LIMITER budget. Returns the successful Response, None for a 4xx
+    answer, and raises RequestFailed once the retries are used up.
     """
     url = SERVER + endpoint
-    retries = 5
-    for attempt in range(retries):
+    problem = None
+    for attempt in range(MAX_RETRIES):
+        RATE_LIMITER.wait()
+        start = time.perf_counter()
         try:
-            r = requests.get(url, headers=HEADERS, params=params, timeout=60)
-            if r.status_code == 429:
-                wait = float(r.headers.get("Retry-After", 2))
-                time.sleep(wait)
-                continue
-            if r.ok: return r.json()
+            if data is not None:
+                r = SESSION.post(url, params=params, json=data, timeout=60, stream=stream)
             else:
-                if r.status_code == 404: return None
-                return None
-        except requests.exceptions.RequestException:
-            time.sleep(2)
-    return None
+                r = SESSION.get(url, params=params, timeout=60, stream=stream)
+        except requests.exceptions.RequestException as e:
+            problem = f"{type(e).__name__}: {e}"
+            time.sleep(backoff_delay(attempt))
+            continue
+        LATENCY.record(endpoint, time.perf_counter() - start)
+        RATE_LIMITER.observe(r.headers)
+
+        if r.status_code == 429:
+            wait = float(r.headers.get("Retry-After", 2))
+            RATE_LIMITER.pause(wait)
+            problem = "HTTP 429"
+            continue
+        if r.ok:
+            return r
+        if r.status_code >= 500:
+            problem = f"HTTP {r.status_code}"
+            time.sleep(backoff_delay(attempt))
+            continue
+        # 4xx (404 = unknown ID): not worth retrying
+        return None
+
+    print(f"    [!] Giving up on {endpoint} after {MAX_RETRIES} attempts ({problem})")
+    raise RequestFailed(f"{endpoint}: {problem}")
+
+def fetch_url(endpoint, params=None, data=None):
+    """
+    Fetches JSON data through send_request().
+    If `data` is given it is sent as a JSON POST body (batch endpoints).
+    Successful responses are served from / stored in RESPONSE_CACHE.
+    Returns None for a 4xx answer; RequestFailed propagates.
+    """
+    cache_key = None
+    if RESPONSE_CACHE is not None:
+        cache_key = ResponseCache.make_key(endpoint, params, data)
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+    r = send_request(endpoint, params, data)
+    if r is None:
+        return None
+    result = r.json()
+    if cache_key is not None:
+        RESPONSE_CACHE.put(cache_key, result)
+    return result
+
+def open_response_cache():
+    """
+    Opens CACHE_FILE and ties it to the current Ensembl release (/info/data).
+    Returns None (no caching) if the release cannot be determined.
+    """
+    if not CACHE_FILE:
+        return None
+    try:
+        info = fetch_url("/info/data")
+    except RequestFailed:
+        info = None
+    releases = info.get('releases') if info else None
+    if not releases:
+        print("Warning: could not read the Ensembl release; response cache disabled.")
+        return None
+
+    release = max(releases)
+    cache = ResponseCache(CACHE_FILE, CACHE_MAX_MB * 1024 * 1024)
+    if cache.set_release(release):
+        print(f"Ensembl release changed to {release}: response cache cleared.")
+    print(f"Response cache: {CACHE_FILE} (release {release})")
+    return cache
 
 def get_gene_symbol(gene_id):
+    """Display name (the ID itself if Ensembl has none), or None if the lookup failed on the network."""
+    if LOCAL_MIRROR is not None:
+        return LOCAL_MIRROR.gene_symbol(gene_id)
     endpoint = f"/lookup/id/{gene_id}"
-    data = fetch_url(endpoint)
+    try:
+        data = fetch_url(endpoint)
+    except RequestFailed:
+        return None
     if data and 'display_name' in data:
         return data['display_name']
     return gene_id
 
+def homology_params(**params):
+    """/homology query params plus the server-side taxon/species allowlist."""
+    if TARGET_TAXA:
+        params['target_taxon'] = list(TARGET_TAXA)
+    if TARGET_SPECIES:
+        params['target_species'] = list(TARGET_SPECIES)
+    return params
+
+def missing_target_taxa():
+    """FISH_CLADES entries that FISH_TAXONOMY_LEVELS keeps but TARGET_TAXA leaves out."""
+    if not TARGET_TAXA:
+        return []
+    return [f"{name} [{taxon}] -> {level}" for taxon, (name, level) in FISH_CLADES.items()
+            if level in FISH_TAXONOMY_LEVELS and taxon not in TARGET_TAXA]
+
 def get_orthologs(gene_id):
     """
-    Fetches orthologs and filters STRICTLY by the taxonomy_level field.
+    Fetches orthologs (pre-filtered on the server by TARGET_TAXA/TARGET_SPECIES)
+    and filters STRICTLY by the taxonomy_level field.
+    Returns None if the homology request itself failed.
     """
+    if LOCAL_MIRROR is not None:
+        return LOCAL_MIRROR.orthologs(gene_id)
+
     endpoint = f"/homology/id/human/{gene_id}"
-    params = {"type": "orthologues", "format": "condensed"}
+    params = homology_params(type="orthologues", format="condensed")
 
-    data = fetch_url(endpoint, params)
+    try:
+        data = fetch_url(endpoint, params)
+    except RequestFailed:
+        return None
     results = []
 
+    if data is None:
+        return None
     if not data or 'data' not in data or not isinstance(data['data'], list) or len(data['data']) == 0:
         return results
 
@@ -81,7 +437,10 @@ def get_orthologs(gene_id):
     return results
 
 def get_transcript_and_cds(protein_id):
+    """(transcript_id, cds), (None, None) if not found; RequestFailed propagates."""
     if not protein_id: return None, None
+    if LOCAL_MIRROR is not None:
+        return LOCAL_MIRROR.transcript_and_cds(protein_id)
 
     # 1. Get Parent Transcript
     endpoint_trans = f"/overlap/translation/{protein_id}"
@@ -102,10 +461,657 @@ def get_transcript_and_cds(protein_id):
         sequence = data_seq['seq']
     return transcript_id, sequence
 
+# ==========================================
+# BATCHED RETRIEVAL
+# ==========================================
+
+def chunked(items, size):
+    """Yields consecutive slices of `items` of at most `size` elements."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def lookup_ids(ids):
+    """
+    POST /lookup/id in chunks of LOOKUP_BATCH_SIZE.
+    Returns ({id: record} for every ID Ensembl knows about,
+    set of IDs whose chunk failed on the network).
+    """
+    records = {}
+    failed = set()
+    for chunk in chunked(list(dict.fromkeys(ids)), LOOKUP_BATCH_SIZE):
+        try:
+            data = fetch_url("/lookup/id", data={"ids": chunk})
+        except RequestFailed:
+            failed.update(chunk)
+            continue
+        if data:
+            records.update({k: v for k, v in data.items() if v})
+    return records, failed
+
+def get_gene_symbols(gene_ids):
+    """
+    Batched get_gene_symbol(): {gene_id: display_name} for the IDs that were resolved.
+    Missing IDs (failed chunk, or no display name) are left to get_gene_symbol().
+    """
+    if LOCAL_MIRROR is not None:
+        return {g: LOCAL_MIRROR.gene_symbol(g) for g in gene_ids}
+    records, _ = lookup_ids(gene_ids)
+    return {g: r['display_name'] for g, r in records.items() if 'display_name' in r}
+
+def get_cds_sequences(transcript_ids):
+    """
+    POST /sequence/id?type=cds in chunks of SEQUENCE_BATCH_SIZE.
+    Returns ({transcript_id: cds}, set of IDs whose chunk failed on the network).
+    """
+    sequences = {}
+    failed = set()
+    for chunk in chunked(list(dict.fromkeys(transcript_ids)), SEQUENCE_BATCH_SIZE):
+        try:
+            data = fetch_url("/sequence/id", params={"type": "cds"}, data={"ids": chunk})
+        except RequestFailed:
+            failed.update(chunk)
+            continue
+        for entry in data or []:
+            key = entry.get('query') or entry.get('id')
+            if key and 'seq' in entry:
+                sequences[key] = entry['seq']
+    return sequences, failed
+
+def get_transcripts_and_cds(protein_ids):
+    """
+    Batched get_transcript_and_cds().
+    A /lookup/id on a translation returns its parent transcript, so two batch
+    calls replace the per-protein /overlap/translation + /sequence/id pair.
+    Returns {protein_id: (transcript_id, cds)}, with (None, None) for proteins
+    Ensembl doesn't know and None for those lost to a network failure.
+    """
+    if LOCAL_MIRROR is not None:
+        return {pid: LOCAL_MIRROR.transcript_and_cds(pid) for pid in protein_ids}
+    translations, failed = lookup_ids(protein_ids)
+    parents = {pid: rec.get('Parent') for pid, rec in translations.items() if rec.get('Parent')}
+    cds, failed_cds = get_cds_sequences(list(parents.values()))
+
+    results = {}
+    for pid in protein_ids:
+        tid = parents.get(pid)
+        if pid in failed or tid in failed_cds:
+            results[pid] = None
+        else:
+            results[pid] = (tid, cds.get(tid)) if tid and cds.get(tid) else (None, None)
+    return results
+
+# ==========================================
+# PROTEIN MEMO
+# ==========================================
+
+class ProteinMemo:
+    """
+    Run-wide protein_id -> (transcript_id, cds) memo: a bounded LRU in memory,
+    optionally spilling evicted entries to a SQLite file instead of dropping
+    them. Only successful resolutions are stored. (In async mode, genes that
+    are in flight together can still resolve a shared protein twice.)
+    """
+    def __init__(self, max_entries, spill_path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.saved_requests = 0
+        self.spill_path = spill_path
+        self.spill = None
+        if spill_path:
+            if os.path.exists(spill_path):
+                os.remove(spill_path)  # Memo is per run; the response cache persists
+            self.spill = sqlite3.connect(spill_path, check_same_thread=False, isolation_level=None)
+            self.spill.execute("CREATE TABLE memo (pid TEXT PRIMARY KEY, tid TEXT, seq TEXT)")
+
+    def get_many(self, protein_ids):
+        found = {}
+        with self.lock:
+            for pid in dict.fromkeys(protein_ids):
+                if pid in self.entries:
+                    self.entries.move_to_end(pid)
+                    found[pid] = self.entries[pid]
+                elif self.spill is not None:
+                    row = self.spill.execute("SELECT tid, seq FROM memo WHERE pid = ?", (pid,)).fetchone()
+                    if row:
+                        found[pid] = tuple(row)
+                        self._store(pid, found[pid])
+            self.hits += len(found)
+        return found
+
+    def put_many(self, resolved):
+        with self.lock:
+            for pid, result in resolved.items():
+                if result and result[0] and result[1]:
+                    self._store(pid, result)
+
+    def _store(self, pid, value):
+        self.entries[pid] = value
+        self.entries.move_to_end(pid)
+        while len(self.entries) > self.max_entries:
+            old_pid, (tid, seq) = self.entries.popitem(last=False)
+            if self.spill is not None:
+                self.spill.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?)", (old_pid, tid, seq))
+
+    def count_saved(self, n_requests):
+        with self.lock:
+            self.saved_requests += n_requests
+
+    def report(self):
+        print(f"\nProtein memo: {self.hits} proteins reused across genes, ~{self.saved_requests} requests saved")
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill_path)
+
+PROTEIN_MEMO = ProteinMemo(PROTEIN_MEMO_SIZE)  # Reopened in main() with the spill file
+
+def batch_requests_needed(n_ids):
+    """Number of POSTs get_transcripts_and_cds() makes for n_ids proteins."""
+    return math.ceil(n_ids / LOOKUP_BATCH_SIZE) + math.ceil(n_ids / SEQUENCE_BATCH_SIZE)
+
+def resolve_one(protein_id):
+    """get_transcript_and_cds(), or None if it failed on the network."""
+    try:
+        return get_transcript_and_cds(protein_id)
+    except RequestFailed:
+        return None
+
+def resolve_sequences(orthologs):
+    """
+    Returns one (transcript_id, cds) pair per ortholog, batched or one by one
+    (None where the lookup failed on the network, so it is retried later).
+    Proteins already resolved for another gene come from PROTEIN_MEMO.
+    """
+    protein_ids = [o['target_protein_id'] for o in orthologs]
+    known = PROTEIN_MEMO.get_many(protein_ids)
+    missing = [pid for pid in dict.fromkeys(protein_ids) if pid not in known]
+
+    if BATCH_LOOKUPS:
+        resolved = get_transcripts_and_cds(missing)
+        PROTEIN_MEMO.count_saved(batch_requests_needed(len(known) + len(missing)) - batch_requests_needed(len(missing)))
+    else:
+        resolved = {pid: resolve_one(pid) for pid in missing}
+        PROTEIN_MEMO.count_saved(2 * len(known))
+    PROTEIN_MEMO.put_many(resolved)
+
+    resolved.update(known)
+    return [resolved[pid] for pid in protein_ids]
+
+def resolve_protein(protein_id):
+    """Memoized get_transcript_and_cds() for the unbatched async path."""
+    known = PROTEIN_MEMO.get_many([protein_id])
+    if known:
+        PROTEIN_MEMO.count_saved(2)
+        return known[protein_id]
+    result = resolve_one(protein_id)
+    PROTEIN_MEMO.put_many({protein_id: result})
+    return result
+
+# ==========================================
+# RUN JOURNAL
+# ==========================================
+
+class RunJournal:
+    """
+    Append-only JSONL log of download progress, one event per line:
+      orthologs: the filtered ortholog list (and symbol) of a gene
+      sequence:  one resolved protein -> (transcript, CDS)
+      complete:  gene finished, with its output files and their SHA-256
+    Replaying it tells a restarted run which genes to skip and which
+    orthologs of a half-finished gene are already resolved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.genes = {}
+        if os.path.exists(path):
+            self._replay()
+            self._compact()
+        self.handle = open(path, 'a')
+
+    def _gene(self, gene):
+        return self.genes.setdefault(gene, {'status': 'pending', 'sequences': {}})
+
+    def _replay(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from a crash
+                state = self._gene(event['gene'])
+                kind = event['event']
+                if kind == 'orthologs':
+                    state['gene_name'] = event['gene_name']
+                    state['orthologs'] = event['orthologs']
+                elif kind == 'sequence':
+                    state['sequences'][event['protein_id']] = (event['transcript_id'], event['seq'])
+                elif kind == 'complete':
+                    state['status'] = 'complete'
+                    state['files'] = event['files']
+
+    def _compact(self):
+        """Rewrites the journal without per-ortholog events of finished genes."""
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            for gene, state in self.genes.items():
+                for event in self._events(gene, state):
+                    f.write(json.dumps(event) + "\n")
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _events(gene, state):
+        if state['status'] == 'complete':
+            yield {'event': 'complete', 'gene': gene, 'files': state['files']}
+            return
+        if 'orthologs' in state:
+            yield {'event': 'orthologs', 'gene': gene, 'gene_name': state['gene_name'],
+                   'orthologs': state['orthologs']}
+        for pid, (tid, seq) in state['sequences'].items():
+            yield {'event': 'sequence', 'gene': gene, 'protein_id': pid,
+                   'transcript_id': tid, 'seq': seq}
+
+    def _write(self, event):
+        with self.lock:
+            self.handle.write(json.dumps(event) + "\n")
+            self.handle.flush()
+
+    def is_complete(self, gene):
+        """True if the gene finished and its output files are unchanged on disk."""
+        state = self.genes.get(gene)
+        if not state or state['status'] != 'complete':
+            return False
+        for path, checksum in state['files'].items():
+            if not os.path.exists(path) or file_digest(path) != checksum:
+                state['status'] = 'pending'
+                return False
+        return True
+
+    def is_partial(self, gene):
+        state = self.genes.get(gene)
+        return bool(state) and state['status'] != 'complete' and 'orthologs' in state
+
+    def orthologs(self, gene):
+        """(gene_name, orthologs) recorded for the gene, or None."""
+        state = self.genes.get(gene)
+        if state and 'orthologs' in state:
+            return state['gene_name'], [dict(o) for o in state['orthologs']]
+        return None
+
+    def record_orthologs(self, gene, gene_name, orthologs):
+        state = self._gene(gene)
+        state['gene_name'] = gene_name
+        state['orthologs'] = [dict(o) for o in orthologs]
+        self._write({'event': 'orthologs', 'gene': gene, 'gene_name': gene_name,
+                     'orthologs': state['orthologs']})
+
+    def pending(self, gene, orthologs):
+        """Orthologs whose CDS has not been resolved yet."""
+        done = self._gene(gene)['sequences']
+        return [o for o in orthologs if o['target_protein_id'] not in done]
+
+    def record_sequences(self, gene, orthologs, sequences):
+        """Journals the resolved pairs; None (network failure) and (None, None) are skipped."""
+        done = self._gene(gene)['sequences']
+        for ortho, result in zip(orthologs, sequences):
+            tid, seq = result or (None, None)
+            if tid and seq:
+                pid = ortho['target_protein_id']
+                done[pid] = (tid, seq)
+                self._write({'event': 'sequence', 'gene': gene, 'protein_id': pid,
+                             'transcript_id': tid, 'seq': seq})
+
+    def sequences(self, gene, orthologs):
+        """One (transcript_id, cds) pair per ortholog from what has been resolved."""
+        done = self._gene(gene)['sequences']
+        return [done.get(o['target_protein_id'], (None, None)) for o in orthologs]
+
+    def record_complete(self, gene, paths):
+        state = self._gene(gene)
+        state['status'] = 'complete'
+        state['files'] = {p: file_digest(p) for p in paths}
+        state['sequences'] = {}
+        self._write({'event': 'complete', 'gene': gene, 'files': state['files']})
+
+    def close(self):
+        self.handle.close()
+
+JOURNAL = None  # Opened in main()
+
+# ==========================================
+# FULL HOMOLOGY MODE
+# ==========================================
+
+def iter_json_array(chunks, key):
+    """
+    Yields the objects of the first JSON array stored under `key`, decoding
+    them one at a time from an iterable of text chunks, so a large response
+    is never held (or parsed) as a whole.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    marker = f'"{key}"'
+    buf = ""
+
+    # 1. Skip ahead to the opening bracket of the array
+    while True:
+        pos = buf.find(marker)
+        if pos >= 0:
+            bracket = buf.find("[", pos + len(marker))
+            if bracket >= 0:
+                buf = buf[bracket + 1:]
+                break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buf += chunk
+
+    # 2. Decode one element at a time, pulling more text when an element is incomplete
+    while True:
+        buf = buf.lstrip(" \t\r\n,")
+        if buf.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError(f"JSON stream ended inside '{key}'")
+            buf += chunk
+            continue
+        yield item
+        buf = buf[end:]
+
+def stream_fish_homologies(endpoint, params):
+    """
+    Streams a format=full homology response and keeps only the fish entries
+    (trimmed to the fields we use). Returns None if the download failed.
+    """
+    try:
+        r = send_request(endpoint, params, stream=True)
+    except RequestFailed:
+        return None
+    if r is None:
+        return None
+
+    text = codecs.getincrementaldecoder("utf-8")()
+    kept = []
+    try:
+        with r:
+            for h in iter_json_array((text.decode(b) for b in r.iter_content(65536)), "homologies"):
+                if h.get('taxonomy_level') not in FISH_TAXONOMY_LEVELS:
+                    continue
+                target = h.get('target') or {}
+                kept.append({
+                    'type': h.get('type'),
+                    'taxonomy_level': h.get('taxonomy_level'),
+                    'species': target.get('species'),
+                    'id': target.get('id'),
+                    'protein_id': target.get('protein_id'),
+                    # aligned=0 gives the plain sequence; older servers name it "seq"
+                    'cds': target.get('align_seq') or target.get('seq'),
+                })
+    except (ValueError, requests.exceptions.RequestException) as e:
+        print(f"    [!] Broken homology stream for {endpoint}: {e}")
+        return None
+    return kept
+
+def get_orthologs_with_cds(gene_id):
+    """
+    Full-mode counterpart of get_orthologs() + resolve_sequences():
+    orthologs and their CDS come from a single /homology response, and the
+    transcript IDs for the FASTA headers from one batched /lookup/id on the
+    protein IDs (the translation's Parent). Returns (orthologs, sequences),
+    or (None, None) if the homology request failed.
+    """
+    endpoint = f"/homology/id/human/{gene_id}"
+    params = homology_params(type="orthologues", format="full", sequence="cds", aligned=0)
+
+    # Only the fish subset is cached, so the filter is part of the key
+    kept = None
+    cache_key = None
+    if RESPONSE_CACHE is not None:
+        cache_key = ResponseCache.make_key(endpoint, params, {"taxonomy_levels": sorted(FISH_TAXONOMY_LEVELS)})
+        kept = RESPONSE_CACHE.get(cache_key)
+    if kept is None:
+        kept = stream_fish_homologies(endpoint, params)
+        if kept is None:
+            return None, None
+        if cache_key is not None:
+            RESPONSE_CACHE.put(cache_key, kept)
+
+    orthologs = []
+    cds = []
+    for h in kept:
+        if not h['protein_id']:
+            continue
+        orthologs.append({
+            'source_gene': gene_id,
+            'species': h['species'],
+            'target_gene_id': h['id'],
+            'target_protein_id': h['protein_id'],
+            'homology_type': h['type'],
+            'taxonomy_level': h['taxonomy_level']
+        })
+        cds.append(h['cds'])
+
+    translations, failed = lookup_ids([o['target_protein_id'] for o in orthologs])
+    sequences = []
+    for ortho, seq in zip(orthologs, cds):
+        if ortho['target_protein_id'] in failed:
+            sequences.append(None)  # Transcript lookup failed; resolved again per protein
+            continue
+        tid = translations.get(ortho['target_protein_id'], {}).get('Parent')
+        sequences.append((tid, seq) if tid and seq else (None, None))
+    return orthologs, sequences
+
+def fetch_gene_orthologs(gene):
+    """
+    Fetches a gene's fish orthologs in the configured HOMOLOGY_MODE.
+    Returns (orthologs, sequences); sequences is None when the CDS still has
+    to be resolved per protein, orthologs is None when the download failed.
+    """
+    if HOMOLOGY_MODE == "full" and LOCAL_MIRROR is None:
+        return get_orthologs_with_cds(gene)
+    orthologs = get_orthologs(gene)
+    if orthologs is None:
+        return None, None
+    return [o for o in orthologs if o['target_protein_id']], None
+
+# ==========================================
+# LOCAL MIRROR BACKEND
+# ==========================================
+
+def strip_version(stable_id):
+    """ENSDART00000012345.4 -> ENSDART00000012345"""
+    return stable_id.split(".")[0]
+
+def header_field(header, name):
+    """Value of a 'name:value' token in an Ensembl FASTA header, or None."""
+    prefix = name + ":"
+    for token in header.split():
+        if token.startswith(prefix):
+            return token[len(prefix):]
+    return None
+
+class LocalMirrorBackend:
+    """
+    Answers get_gene_symbol() / get_orthologs() / get_transcript_and_cds()
+    from local Ensembl dumps instead of the REST API.
+
+    The first run scans every file once and stores byte offsets in a SQLite
+    index: homology lines per human gene, sequence start/length per
+    transcript, protein -> transcript from the peptide headers and gene
+    symbols. Later lookups seek straight to the data. The index is rebuilt
+    whenever a source file's size or modification time changes.
+    """
+    def __init__(self, index_path, homology_files, cds_files, pep_files, taxonomy_file=None):
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.taxonomy = self._load_taxonomy(taxonomy_file)
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        sources = [("homology", p) for p in homology_files] + \
+                  [("cds", p) for p in cds_files] + [("pep", p) for p in pep_files]
+        if not self._index_is_current(sources):
+            self._build_index(sources)
+        self.paths = dict(self.db.execute("SELECT file_id, path FROM files"))
+        self.columns = {row[0]: json.loads(row[1]) for row in self.db.execute("SELECT file_id, columns FROM files")}
+
+    @staticmethod
+    def _load_taxonomy(path):
+        taxonomy = {}
+        if path:
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) >= 2 and not line.startswith("#"):
+                        taxonomy[parts[0]] = parts[1]
+        return taxonomy
+
+    @staticmethod
+    def _signature(path):
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_size, int(st.st_mtime)]
+
+    def _index_is_current(self, sources):
+        try:
+            stored = self.db.execute("SELECT kind, path, size, mtime FROM files ORDER BY file_id").fetchall()
+        except sqlite3.OperationalError:
+            return False
+        return [list(r) for r in stored] == [[kind] + self._signature(p) for kind, p in sources]
+
+    def _build_index(self, sources):
+        print(f"Indexing local mirror ({len(sources)} files)...")
+        db = self.db
+        for table in ("files", "homology", "sequences", "parents", "symbols"):
+            db.execute(f"DROP TABLE IF EXISTS {table}")
+        db.execute("CREATE TABLE files (file_id INTEGER PRIMARY KEY, kind TEXT, path TEXT, size INTEGER, mtime INTEGER, columns TEXT)")
+        db.execute("CREATE TABLE homology (gene TEXT, file_id INTEGER, offset INTEGER)")
+        db.execute("CREATE TABLE sequences (id TEXT PRIMARY KEY, file_id INTEGER, offset INTEGER, length INTEGER)")
+        db.execute("CREATE TABLE parents (protein TEXT PRIMARY KEY, transcript TEXT)")
+        db.execute("CREATE TABLE symbols (gene TEXT PRIMARY KEY, symbol TEXT)")
+
+        for file_id, (kind, path) in enumerate(sources):
+            columns = None
+            if kind == "homology":
+                columns = self._index_homology(file_id, path)
+            else:
+                self._index_fasta(file_id, path, kind)
+            db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                       [file_id, kind] + self._signature(path) + [json.dumps(columns)])
+
+        db.execute("CREATE INDEX homology_gene ON homology (gene)")
+        db.commit()
+
+    def _index_homology(self, file_id, path):
+        """Offsets of the ortholog lines whose source gene is human."""
+        rows = []
+        with open(path, 'rb') as f:
+            header = f.readline()
+            columns = header.decode().rstrip("\r\n").split("\t")
+            col = {name: i for i, name in enumerate(columns)}
+            gene_i, species_i, type_i = col['gene_stable_id'], col['species'], col['homology_type']
+            offset = len(header)
+            for line in f:
+                parts = line.split(b"\t")
+                if parts[species_i] == b"homo_sapiens" and b"ortholog" in parts[type_i]:
+                    rows.append((strip_version(parts[gene_i].decode()), file_id, offset))
+                offset += len(line)
+        self.db.executemany("INSERT INTO homology VALUES (?, ?, ?)", rows)
+        return columns
+
+    def _index_fasta(self, file_id, path, kind):
+        """
+        cds: where each transcript's sequence starts and how many bytes it spans.
+        pep: protein -> transcript. Both: gene -> symbol.
+        """
+        sequences, parents, symbols = [], [], {}
+        current = None  # [id, start]
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if current:
+                        sequences.append((current[0], file_id, current[1], offset - current[1]))
+                    header = line[1:].decode().strip()
+                    seq_id = strip_version(header.split()[0])
+                    gene, symbol = header_field(header, "gene"), header_field(header, "gene_symbol")
+                    if gene and symbol:
+                        symbols[strip_version(gene)] = symbol
+                    if kind == "pep":
+                        transcript = header_field(header, "transcript")
+                        if transcript:
+                            parents.append((seq_id, strip_version(transcript)))
+                    current = [seq_id, offset + len(line)] if kind == "cds" else None
+                offset += len(line)
+            if current:
+                sequences.append((current[0], file_id, current[1], offset - current[1]))
+        self.db.executemany("INSERT OR REPLACE INTO sequences VALUES (?, ?, ?, ?)", sequences)
+        self.db.executemany("INSERT OR REPLACE INTO parents VALUES (?, ?)", parents)
+        self.db.executemany("INSERT OR REPLACE INTO symbols VALUES (?, ?)", symbols.items())
+
+    def _read(self, file_id, offset, length=None):
+        """Random access into a source file (one shared handle per file)."""
+        with self.lock:
+            handle = self.handles.get(file_id)
+            if handle is None:
+                handle = self.handles[file_id] = open(self.paths[file_id], 'rb')
+            handle.seek(offset)
+            return handle.read(length) if length is not None else handle.readline()
+
+    def _query(self, sql, args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def gene_symbol(self, gene_id):
+        rows = self._query("SELECT symbol FROM symbols WHERE gene = ?", (strip_version(gene_id),))
+        return rows[0][0] if rows else gene_id
+
+    def orthologs(self, gene_id):
+        """Same records as the REST get_orthologs(), filtered by FISH_TAXONOMY_LEVELS."""
+        results = []
+        rows = self._query("SELECT file_id, offset FROM homology WHERE gene = ? ORDER BY rowid", (strip_version(gene_id),))
+        for file_id, offset in rows:
+            values = self._read(file_id, offset).decode().rstrip("\r\n").split("\t")
+            h = dict(zip(self.columns[file_id], values))
+            species = h.get('homology_species')
+            tax_level = h.get('taxonomy_level') or self.taxonomy.get(species)
+            if tax_level in FISH_TAXONOMY_LEVELS:
+                results.append({
+                    'source_gene': gene_id,
+                    'species': species,
+                    'target_gene_id': h.get('homology_gene_stable_id'),
+                    'target_protein_id': h.get('homology_protein_stable_id'),
+                    'homology_type': h.get('homology_type'),
+                    'taxonomy_level': tax_level
+                })
+        return results
+
+    def transcript_and_cds(self, protein_id):
+        rows = self._query("SELECT transcript FROM parents WHERE protein = ?", (strip_version(protein_id),))
+        if not rows:
+            return None, None
+        transcript_id = rows[0][0]
+        rows = self._query("SELECT file_id, offset, length FROM sequences WHERE id = ?", (transcript_id,))
+        if not rows:
+            return None, None
+        raw = self._read(*rows[0])
+        return transcript_id, raw.decode().replace("\n", "").replace("\r", "")
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.db.close()
+
+LOCAL_MIRROR = None  # Opened in main() when BACKEND == "local"
+
 def create_unique_list(input_file):
     """
     Reads the input file, removes duplicates while preserving order,
-    and writes the result to a new file.
+    and writes the result to a new file (left untouched if already identical).
     """
     unique_genes = []
     seen = set()
@@ -119,9 +1125,14 @@ def create_unique_list(input_file):
                 unique_genes.append(g)
 
     # Write to new file
-    with open(UNIQUE_LIST_FILENAME, 'w') as f:
-        for g in unique_genes:
-            f.write(g + "\n")
+    content = "".join(g + "\n" for g in unique_genes)
+    existing = None
+    if os.path.exists(UNIQUE_LIST_FILENAME):
+        with open(UNIQUE_LIST_FILENAME, 'r') as f:
+            existing = f.read()
+    if content != existing:
+        with open(UNIQUE_LIST_FILENAME, 'w') as f:
+            f.write(content)
 
     print(f"--- PRE-PROCESSING ---")
     print(f"Input file: {input_file}")
@@ -131,12 +1142,183 @@ def create_unique_list(input_file):
 
     return unique_genes
 
+CSV_LEADING_COLUMNS = ['source_gene_name', 'source_gene', 'species', 'taxonomy_level']
+
+def save_gene_files(gene, gene_name, orthologs, sequences):
+    """
+    Streams the per-gene CSV and FASTA one ortholog at a time (via temp files,
+    so a crash never leaves a half-written output behind).
+    `sequences` holds one (transcript_id, cds) pair per ortholog, in the same order.
+    Returns the list of files written (empty if there was nothing to save).
+    """
+    csv_filename = os.path.join(OUTPUT_DIR, f"{gene_name}_{gene}_fishes.csv")
+    fasta_filename = os.path.join(OUTPUT_DIR, f"{gene_name}_{gene}_fishes.fasta")
+
+    kept = [(o, tid, seq) for o, (tid, seq) in zip(orthologs, sequences) if tid and seq]
+    if not kept:
+        return []
+
+    # Same layout pandas produced: leading columns, then the rest in first-seen order
+    columns = list(dict.fromkeys(CSV_LEADING_COLUMNS + [k for o, _, _ in kept for k in o] + ['transcript_id']))
+
+    with open(csv_filename + ".part", "w", newline="") as f_csv, open(fasta_filename + ".part", "w") as f_fasta:
+        writer = csv.writer(f_csv, lineterminator=os.linesep)
+        writer.writerow(columns)
+        for n, (ortho, tid, seq) in enumerate(kept):
+            pid = ortho['target_protein_id']
+            row = dict(ortho, transcript_id=tid, source_gene_name=gene_name)
+            writer.writerow([row.get(c) for c in columns])
+
+            # Header format: >Transcript | Protein | Species | GeneName | GeneID | TaxLevel
+            header = f">{tid} | {pid} | {ortho['species']} | {gene_name} | {gene} | {ortho['taxonomy_level']}"
+            if n:
+                f_fasta.write("\n")
+            f_fasta.write(f"{header}\n{seq}")
+
+    os.replace(csv_filename + ".part", csv_filename)
+    os.replace(fasta_filename + ".part", fasta_filename)
+    print(f"    -> Saved: {csv_filename}")
+    print(f"    -> Saved: {fasta_filename} ({len(kept)} seqs)")
+    return [csv_filename, fasta_filename]
+
+def count_failed(sequences):
+    """Lookups lost to network failures (None) in a resolve_sequences() result."""
+    return sum(1 for result in sequences if result is None)
+
+def finish_gene(gene, gene_name, orthologs):
+    """Saves the gene's outputs from the journal and marks it complete."""
+    if not orthologs:
+        print(f"    -> No matching fish orthologs found.")
+        JOURNAL.record_complete(gene, [])
+        return
+    written = save_gene_files(gene, gene_name, orthologs, JOURNAL.sequences(gene, orthologs))
+    if not written:
+        print("    -> No valid CDS sequences retrieved.")
+    JOURNAL.record_complete(gene, written)
+
+def process_gene(gene, index, total, gene_name=None):
+    """Serial path: one request at a time."""
+    print(f"[{index}/{total}] Processing {gene}...")
+
+    if JOURNAL.is_complete(gene):
+        print("    -> Already complete (journal), skipping.")
+        return
+
+    recorded = JOURNAL.orthologs(gene)
+    if recorded:
+        gene_name, orthologs = recorded
+        print(f"    -> Identified as: {gene_name}")
+        print(f"    -> Resuming: {len(orthologs) - len(JOURNAL.pending(gene, orthologs))}/{len(orthologs)} orthologs already fetched.")
+    else:
+        if gene_name is None:
+            gene_name = get_gene_symbol(gene)
+        if gene_name is None:
+            print("    -> Symbol lookup failed; will retry on the next run.")
+            return
+        print(f"    -> Identified as: {gene_name}")
+
+        # Fetch Orthologs
+        orthologs, sequences = fetch_gene_orthologs(gene)
+        if orthologs is None:
+            print("    -> Homology download failed; will retry on the next run.")
+            return
+        if orthologs:
+            print(f"    -> Found {len(orthologs)} fish matches.")
+        JOURNAL.record_orthologs(gene, gene_name, orthologs)
+        if sequences is not None:
+            JOURNAL.record_sequences(gene, orthologs, sequences)
+
+    # Fetch Sequences
+    pending = JOURNAL.pending(gene, orthologs)
+    sequences = resolve_sequences(pending)
+    JOURNAL.record_sequences(gene, pending, sequences)
+
+    failed = count_failed(sequences)
+    if failed:
+        # Not marked complete: the next run resolves only the missing orthologs
+        print(f"    -> {failed} CDS lookups failed on the network; will resume on the next run.")
+        return
+
+    # Save Files
+    finish_gene(gene, gene_name, orthologs)
+
+# ==========================================
+# ASYNC ENGINE
+# ==========================================
+# The blocking fetch functions run in a worker pool sized to CONCURRENCY;
+# RATE_LIMITER keeps the combined request rate inside Ensembl's budget.
+
+async def process_gene_async(gene, index, total, gene_slots, gene_name=None):
+    """Async path: symbol and orthologs together, then all CDS lookups at once."""
+    if JOURNAL.is_complete(gene):
+        print(f"[{index}/{total}] {gene}: already complete (journal), skipping.")
+        return
+
+    async with gene_slots:
+        recorded = JOURNAL.orthologs(gene)
+        if recorded:
+            gene_name, orthologs = recorded
+        else:
+            if gene_name is None:
+                gene_name, (orthologs, sequences) = await asyncio.gather(
+                    asyncio.to_thread(get_gene_symbol, gene),
+                    asyncio.to_thread(fetch_gene_orthologs, gene),
+                )
+            else:
+                orthologs, sequences = await asyncio.to_thread(fetch_gene_orthologs, gene)
+            if gene_name is None or orthologs is None:
+                step = "symbol lookup" if gene_name is None else "homology download"
+                print(f"[{index}/{total}] {gene}: {step} failed; will retry on the next run.")
+                return
+            JOURNAL.record_orthologs(gene, gene_name, orthologs)
+            if sequences is not None:
+                JOURNAL.record_sequences(gene, orthologs, sequences)
+
+        pending = JOURNAL.pending(gene, orthologs)
+        if BATCH_LOOKUPS:
+            sequences = await asyncio.to_thread(resolve_sequences, pending)
+        else:
+            sequences = await asyncio.gather(*[
+                asyncio.to_thread(resolve_protein, o['target_protein_id']) for o in pending
+            ])
+        JOURNAL.record_sequences(gene, pending, sequences)
+
+        failed = count_failed(sequences)
+        if failed:
+            print(f"[{index}/{total}] {gene} ({gene_name}): {failed} CDS lookups failed on the network; "
+                  f"will resume on the next run.")
+            return
+        print(f"[{index}/{total}] {gene} ({gene_name}): {len(orthologs)} fish matches.")
+        finish_gene(gene, gene_name, orthologs)
+
+async def run_async(unique_genes, concurrency, symbols=None):
+    """Runs every gene through process_gene_async, `concurrency` at a time."""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    gene_slots = asyncio.Semaphore(concurrency)
+    symbols = symbols or {}
+    total = len(unique_genes)
+    await asyncio.gather(*[
+        process_gene_async(gene, i + 1, total, gene_slots, symbols.get(gene))
+        for i, gene in enumerate(unique_genes)
+    ])
+
 def main():
+    global RESPONSE_CACHE, JOURNAL, PROTEIN_MEMO, LOCAL_MIRROR
+
     # --- 1. SETUP ---
     if len(sys.argv) < 2:
         print("Usage: python3 fetch_fishes_log_unique.py <gene_ids.txt>")
         sys.exit(1)
 
+    missing = missing_target_taxa()
+    if missing:
+        print("[X] TARGET_TAXA misses clades kept by FISH_TAXONOMY_LEVELS:")
+        for clade in missing:
+            print(f"    {clade}")
+        print("    Add them to TARGET_TAXA, empty it, or drop their level from FISH_TAXONOMY_LEVELS.")
+        sys.exit(1)
+
     input_arg = sys.argv[1]
 
     # Only proceed if it's a file
@@ -150,64 +1332,46 @@ def main():
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
-    print(f"Starting Download...")
-    print(f"Filtering for Taxonomy Levels: {FISH_TAXONOMY_LEVELS}")
-
-    # --- 2. MAIN LOOP ---
-    for i, gene in enumerate(unique_genes):
-        print(f"[{i+1}/{len(unique_genes)}] Processing {gene}...")
-
-        gene_name = get_gene_symbol(gene)
-        print(f"    -> Identified as: {gene_name}")
-
-        # Filenames
-        csv_filename = os.path.join(OUTPUT_DIR, f"{gene_name}_{gene}_fishes.csv")
-        fasta_filename = os.path.join(OUTPUT_DIR, f"{gene_name}_{gene}_fishes.fasta")
-
-        # Fetch Orthologs
-        orthologs = get_orthologs(gene)
-
-        if not orthologs:
-            print(f"    -> No matching fish orthologs found.")
-            continue
+    if BACKEND == "local":
+        LOCAL_MIRROR = LocalMirrorBackend(LOCAL_INDEX_FILE, LOCAL_HOMOLOGY_FILES, LOCAL_CDS_FILES,
+                                          LOCAL_PEP_FILES, LOCAL_SPECIES_TAXONOMY_FILE)
+        print(f"Backend: local mirror ({LOCAL_INDEX_FILE})")
+    else:
+        RESPONSE_CACHE = open_response_cache()
+    PROTEIN_MEMO = ProteinMemo(PROTEIN_MEMO_SIZE, PROTEIN_MEMO_SPILL_FILE)
 
-        print(f"    -> Found {len(orthologs)} fish matches.")
+    JOURNAL = RunJournal(JOURNAL_FILE)
+    done = {g for g in unique_genes if JOURNAL.is_complete(g)}
+    partial = {g for g in unique_genes if JOURNAL.is_partial(g)}
+    if done or partial:
+        print(f"Journal: {len(done)} genes complete (skipped), {len(partial)} to resume.")
 
-        gene_metadata = []
-        gene_fasta_lines = []
-        count = 0
+    print(f"Starting Download...")
+    print(f"Filtering for Taxonomy Levels: {FISH_TAXONOMY_LEVELS}")
+    if LOCAL_MIRROR is None and (TARGET_TAXA or TARGET_SPECIES):
+        print(f"Server-side filter: taxa {TARGET_TAXA}, species {TARGET_SPECIES or 'any'}")
 
-        # Fetch Sequences
-        for ortho in orthologs:
-            pid = ortho['target_protein_id']
-            if not pid: continue
+    # Gene symbols for the whole list in one (or a few) POSTs
+    todo = [g for g in unique_genes if g not in done and g not in partial]
+    symbols = get_gene_symbols(todo) if BATCH_LOOKUPS and todo else {}
 
-            tid, seq = get_transcript_and_cds(pid)
+    # --- 2. MAIN LOOP ---
+    if FETCH_MODE == "async":
+        print(f"Mode: async ({CONCURRENCY} concurrent, max {MAX_REQUESTS_PER_SECOND} req/s)")
+        asyncio.run(run_async(unique_genes, CONCURRENCY, symbols))
+    else:
+        for i, gene in enumerate(unique_genes):
+            process_gene(gene, i + 1, len(unique_genes), symbols.get(gene))
 
-            if tid and seq:
-                ortho['transcript_id'] = tid
-                ortho['source_gene_name'] = gene_name
-                gene_metadata.append(ortho)
-
-                # Header format: >Transcript | Protein | Species | GeneName | GeneID | TaxLevel
-                header = f">{tid} | {pid} | {ortho['species']} | {gene_name} | {gene} | {ortho['taxonomy_level']}"
-                gene_fasta_lines.append(f"{header}\n{seq}")
-                count += 1
-
-        # Save Files
-        if gene_metadata:
-            df = pd.DataFrame(gene_metadata)
-            # Reorder columns
-            cols = ['source_gene_name', 'source_gene', 'species', 'taxonomy_level'] + [c for c in df.columns if c not in ['source_gene_name', 'source_gene', 'species', 'taxonomy_level']]
-            df = df[cols]
-            df.to_csv(csv_filename, index=False)
-
-            with open(fasta_filename, "w") as f:
-                f.write("\n".join(gene_fasta_lines))
-            print(f"    -> Saved: {csv_filename}")
-            print(f"    -> Saved: {fasta_filename} ({count} seqs)")
-        else:
-            print("    -> No valid CDS sequences retrieved.")
+    JOURNAL.close()
+    if LOCAL_MIRROR is not None:
+        LOCAL_MIRROR.close()
+    PROTEIN_MEMO.report()
+    PROTEIN_MEMO.close()
+    LATENCY.report()
+    if RESPONSE_CACHE is not None:
+        print(f"\nResponse cache: {RESPONSE_CACHE.hits} hits, {RESPONSE_CACHE.misses} misses")
+        RESPONSE_CACHE.close()
 
     print("\nAll Done.")
 
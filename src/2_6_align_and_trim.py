@@ -2,6 +2,56 @@ import subprocess
 import os
 import shutil
 import re
+import threading
+import hashlib
+import sys
+import tempfile
+import time
+import signal
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+from alignment import (GAP, Alignment, DigestManifest, read_fasta, format_record, translate, back_translate,
+                       is_stop_codon, file_digest)
+
+try:
+    import numpy as np  # only needed for TRIMMER = "native", ALIGN_MODE = "codon" and CDS_QC
+except ImportError:
+    np = None
+
+# --- CONFIGURATION ---
+# Total cores the scheduler may use at once (MAFFT threads + one per running Gblocks)
+CORE_BUDGET = int(os.environ.get("ALIGN_CORES", os.cpu_count() or 1))
+MAX_THREADS_PER_JOB = 8   # MAFFT --thread ceiling for the largest families
+SEQS_PER_THREAD = 50      # One extra MAFFT thread per this many sequences
+# CDS quality control before aligning (step 2): rejected sequences and reasons are moved from
+# the downloaded <gene>.fasta to qc/<gene>_rejected.fasta, so step 5 only merges clean sequences
+CDS_QC = os.environ.get("CDS_QC", "0") == "1"
+QC_MAX_AMBIGUOUS = 0.05        # Max fraction of non-ACGT bases
+QC_LENGTH_RANGE = (0.5, 2.0)   # Allowed length relative to the family's median length
+# Skip MAFFT/Gblocks when inputs, tool version and parameters match the last run
+USE_SKIP_CACHE = True
+CACHE_MANIFEST = ".align_trim_cache.json"  # Written in the input folder
+MAFFT_OPTIONS = ['--auto']
+# "nucleotide": align the CDS as is; "codon": translate, align the proteins, back-translate
+ALIGN_MODE = os.environ.get("ALIGN_MODE", "nucleotide")
+# "auto": mafft --auto; "adaptive": strategy picked by the cost model (see MAFFT_STRATEGIES);
+# or a fixed strategy name such as "FFT-NS-2"
+MAFFT_STRATEGY = os.environ.get("MAFFT_STRATEGY", "auto")
+STRATEGY_TARGET_SECONDS = 600   # adaptive: most accurate strategy predicted to finish within this
+MAFFT_TIME_BUDGET = 7200        # Hard per-gene limit (s) when not "auto", shared by all strategy attempts
+MIN_ATTEMPT_SECONDS = 60        # Budget kept back for each faster fallback strategy after a timeout
+RUNTIMES_FILE = "mafft_runtimes.tsv"  # Predicted vs actual runtimes (input folder); calibrates the model
+# "gblocks": run Gblocks; "native": experimental in-process NumPy trimmer that follows Gblocks'
+# documented procedure but is not validated against Gblocks output yet (see NATIVE_TRIMMER_VALIDATED)
+TRIMMER = os.environ.get("TRIMMER", "gblocks")
+# Run the unvalidated native trimmer anyway (its trimmed files may differ from Gblocks')
+ALLOW_UNVALIDATED_TRIMMER = os.environ.get("ALLOW_UNVALIDATED_TRIMMER", "0") == "1"
+# Step 6 incremental mode: folder with the step-2 *_aligned.fasta files (e.g. "../Downloads/aligned").
+# When set, only sequences missing from the matching step-2 alignment are added with mafft --add.
+REFERENCE_ALIGNED_DIR = os.environ.get("REFERENCE_ALIGNED_DIR")
+ADD_MODE = "add"          # "add" (full-length sequences) or "addfragments" (partial hits)
+ADD_KEEPLENGTH = False    # --keeplength: keep the step-2 alignment width
 
 # ==========================================
 # 1. HELPER: SEQUENCE MAPPER CLASS
@@ -22,22 +72,13 @@ class SequenceMapper:
         self.mapping = {}
         count = 0
         try:
-            with open(input_path, 'r') as f_in, open(temp_path, 'w') as f_out:
-                for line in f_in:
-                    if line.strip().startswith(">"):
-                        original_header = line.strip()[1:] # Remove '>'
-
-                        # Create safe ID
-                        count += 1
-                        safe_id = f"Seq_{count}"
-
-                        # Store map
-                        self.mapping[safe_id] = original_header
-
-                        # Write safe header
-                        f_out.write(f">{safe_id}\n")
-                    else:
-                        f_out.write(line)
+            with open(temp_path, 'w') as f_out:
+                for original_header, seq in read_fasta(input_path):
+                    # Create safe ID and store map
+                    count += 1
+                    safe_id = f"Seq_{count}"
+                    self.mapping[safe_id] = original_header
+                    f_out.write(format_record(safe_id, seq))
             return True, count
         except Exception as e:
             return False, f"Error creating temp file: {e}"
@@ -48,20 +89,13 @@ class SequenceMapper:
         and writes final_output_path with Original headers.
         """
         try:
-            with open(safe_file_path, 'r') as f_in, open(final_output_path, 'w') as f_out:
-                for line in f_in:
-                    if line.strip().startswith(">"):
-                        # Extract the ID (e.g., Seq_1)
-                        # GBlocks sometimes adds spaces or info after the ID, so we split
-                        safe_id_candidate = line.strip()[1:].split()[0]
-
-                        if safe_id_candidate in self.mapping:
-                            original = self.mapping[safe_id_candidate]
-                            f_out.write(f">{original}\n")
-                        else:
-                            f_out.write(line)
-                    else:
-                        f_out.write(line)
+            with open(final_output_path, 'w') as f_out:
+                # read_fasta also drops the spaces GBlocks puts every 10 positions
+                for header, seq in read_fasta(safe_file_path):
+                    # Extract the ID (e.g., Seq_1)
+                    # GBlocks sometimes adds spaces or info after the ID, so we split
+                    safe_id_candidate = (header.split() or [""])[0]
+                    f_out.write(format_record(self.mapping.get(safe_id_candidate, header), seq))
             return True, "Success"
         except Exception as e:
             return False, f"Error restoring headers: {e}"
@@ -70,12 +104,79 @@ class SequenceMapper:
 # 2. CORE FUNCTIONS
 # ==========================================
 
-def run_mafft(input_file, output_file):
-    """ Runs MAFFT alignment using absolute paths. """
+def base_identifier(filename):
+    """ 'ABHD11_ENSG00000106077_fishes_aligned.fasta' -> 'ABHD11_ENSG00000106077' """
+    parts = os.path.splitext(filename)[0].split('_')
+    return "_".join(parts[:2])
+
+MAFFT_TIMEOUT = "MAFFT timed out."
+
+def run_mafft(input_file, output_file, threads=1, options=None, timeout=None):
+    """ Runs MAFFT alignment using absolute paths (MAFFT_OPTIONS unless `options` given). """
     input_abs = os.path.abspath(input_file)
     output_abs = os.path.abspath(output_file)
 
-    cmd = ['mafft', '--auto', input_abs]
+    cmd = ['mafft'] + (MAFFT_OPTIONS if options is None else options) + [input_abs]
+    if threads > 1:
+        cmd[-1:-1] = ['--thread', str(threads)]
+
+    try:
+        with open(output_abs, 'w') as outf:
+            # Own process group: mafft is a shell script, so a timeout has to kill its children too
+            proc = subprocess.Popen(cmd, stdout=outf, stderr=subprocess.PIPE, text=True, start_new_session=True)
+            try:
+                _, stderr = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.communicate()
+                return False, MAFFT_TIMEOUT
+        if proc.returncode != 0:
+            return False, f"MAFFT Error: {stderr}"
+        return True, "Success"
+    except FileNotFoundError:
+        return False, "MAFFT not found."
+
+def plan_incremental(input_file, reference_file):
+    """
+    Splits input_file into the sequences already in the reference alignment
+    and the new ones. Returns (new_records, None), or (None, reason) when the
+    reference can't be reused (a sequence changed or is no longer in the input).
+    A codon-mode reference holds only codon_core() of each CDS, which also matches.
+    """
+    reference = {h: seq.replace("-", "").upper() for h, seq in read_fasta(reference_file)}
+    new_records, seen = [], 0
+    for header, seq in read_fasta(input_file):
+        if header in reference:
+            if reference[header] not in (seq.upper(), codon_core(seq).upper()):
+                return None, f"sequence changed since step 2: {header.split()[0]}"
+            seen += 1
+        else:
+            new_records.append((header, seq))
+    if seen != len(reference):
+        return None, f"{len(reference) - seen} reference sequence(s) missing from the input"
+    return new_records, None
+
+def run_mafft_add(reference_file, new_records, output_file, threads=1, options=(), keeplength=None):
+    """
+    Adds new_records to an existing alignment (mafft --add/--addfragments).
+    `options` (e.g. --amino) go before the reference; keeplength defaults to ADD_KEEPLENGTH.
+    """
+    output_abs = os.path.abspath(output_file)
+    if not new_records:
+        shutil.copyfile(reference_file, output_abs)
+        return True, "Success"
+
+    new_file = output_abs + ".new"
+    with open(new_file, 'w') as f:
+        for header, seq in new_records:
+            f.write(format_record(header, seq, width=0))
+
+    cmd = ['mafft', f'--{ADD_MODE}', new_file] + list(options)
+    if ADD_KEEPLENGTH if keeplength is None else keeplength:
+        cmd.append('--keeplength')
+    if threads > 1:
+        cmd += ['--thread', str(threads)]
+    cmd.append(os.path.abspath(reference_file))
 
     try:
         with open(output_abs, 'w') as outf:
@@ -85,13 +186,186 @@ def run_mafft(input_file, output_file):
         return False, f"MAFFT Error: {e.stderr}"
     except FileNotFoundError:
         return False, "MAFFT not found."
+    finally:
+        if os.path.exists(new_file):
+            os.remove(new_file)
+
+def seq_id(header):
+    return (header.split() or ["(no name)"])[0]
+
+STOP_CODONS = {"TAA", "TAG", "TGA"}
+
+def codon_core(seq):
+    """ The part of a CDS that codon mode aligns: whole codons, without a terminal stop codon. """
+    n_codons = len(seq) // 3
+    if n_codons and seq[3 * n_codons - 3:3 * n_codons].upper().replace("U", "T") in STOP_CODONS:
+        n_codons -= 1
+    return seq[:3 * n_codons]
+
+def _say(msg, log):
+    if log is None:
+        print(msg)
+    else:
+        log.append(msg)
+
+def codon_translations(records, log=None):
+    """
+    Translations for codon mode (terminal stop removed). Sequences whose length
+    is not a multiple of 3 or that have internal stop codons are reported; those
+    with an empty translation (shorter than one codon, or only a stop codon) are
+    reported and left out. Returns (records, proteins) of the kept sequences.
+    """
+    proteins = translate([seq for _, seq in records])
+    proteins = [p[:-1] if p.endswith("*") else p for p in proteins]
+    empty = [seq_id(h) for (h, _), p in zip(records, proteins) if not p]
+    checks = [
+        ("length not a multiple of 3", [seq_id(h) for h, seq in records if len(seq) % 3]),
+        ("internal stop codons", [seq_id(h) for (h, _), p in zip(records, proteins) if "*" in p]),
+        ("an empty translation (left out of the alignment)", empty),
+    ]
+    for label, ids in checks:
+        if ids:
+            _say(f"    -> Codon check: {len(ids)} sequence(s) with {label}: {', '.join(ids)}", log)
+    kept = [(record, p) for record, p in zip(records, proteins) if p]
+    return [record for record, _ in kept], [p for _, p in kept]
+
+def translate_codon_alignment(reference_file):
+    """
+    Translates a codon-mode alignment codon by codon ('---' -> '-', internal
+    stops -> X). Returns [(header, aligned protein, ungapped CDS)]; raises
+    ValueError if a row is not whole codons and gap triplets (e.g. a
+    nucleotide-mode alignment).
+    """
+    rows = []
+    for header, aligned in read_fasta(reference_file):
+        if len(aligned) % 3:
+            raise ValueError(f"{seq_id(header)}: length {len(aligned)} is not a multiple of 3")
+        triplets = np.frombuffer(aligned.encode('ascii'), dtype=np.uint8).reshape(-1, 3) == GAP
+        gap_codon = triplets.all(axis=1)
+        if (triplets.any(axis=1) & ~gap_codon).any():
+            raise ValueError(f"{seq_id(header)}: gaps split a codon")
+        cds = aligned.replace("-", "")
+        protein = np.full(len(gap_codon), GAP, dtype=np.uint8)
+        protein[~gap_codon] = np.frombuffer(translate([cds])[0].replace("*", "X").encode('ascii'), dtype=np.uint8)
+        rows.append((header, protein.tobytes().decode('ascii'), cds))
+    return rows
+
+def run_codon_alignment(input_file, output_file, align, log=None):
+    """
+    Codon mode: translates the CDS, aligns the proteins with align(in, out)
+    and threads the codons back onto the protein alignment, so frames stay
+    intact. Sequences whose length is not a multiple of 3 or that have
+    internal stop codons are reported; they are still aligned (the partial
+    codon is dropped, internal stops are aligned as X). Terminal stop codons
+    are left out of the alignment. Sequences with an empty translation
+    (shorter than one codon, or only a stop codon) are reported and left out.
+    """
+    if np is None:
+        return False, "NumPy is required for ALIGN_MODE = 'codon'."
+    records = list(read_fasta(input_file))
+    if not records:
+        return False, "Input contains 0 sequences."
+    records, proteins = codon_translations(records, log)
+    if not records:
+        return False, "No sequence has a non-empty translation."
+
+    output_abs = os.path.abspath(output_file)
+    protein_file, protein_aln = output_abs + ".pep", output_abs + ".pep.aln"
+    try:
+        with open(protein_file, 'w') as f:
+            for i, protein in enumerate(proteins):
+                f.write(format_record(f"p{i}", protein.replace("*", "X")))
+        ok, msg = align(protein_file, protein_aln)
+        if not ok:
+            return False, msg
+        aligned = dict(read_fasta(protein_aln))
+        with open(output_abs, 'w') as f:
+            for i, (header, seq) in enumerate(records):
+                f.write(format_record(header, back_translate(aligned[f"p{i}"], seq)))
+        return True, "Success"
+    except (KeyError, ValueError) as e:
+        return False, f"Back-translation failed: {e}"
+    finally:
+        for temp in (protein_file, protein_aln):
+            if os.path.exists(temp):
+                os.remove(temp)
+
+def run_codon_add(reference_file, new_records, output_file, threads=1, log=None):
+    """
+    Codon-mode incremental step: translates the step-2 codon alignment and the
+    new sequences, adds the new proteins with mafft --add --amino and threads
+    the codons of every sequence back onto the protein alignment. --keeplength
+    is not used: MAFFT would drop inserted residues that can't be traced back
+    to their codons.
+    """
+    if np is None:
+        return False, "NumPy is required for ALIGN_MODE = 'codon'."
+    output_abs = os.path.abspath(output_file)
+    if not new_records:
+        shutil.copyfile(reference_file, output_abs)
+        return True, "Success"
+    if ADD_KEEPLENGTH:
+        _say("    -> ADD_KEEPLENGTH is ignored in codon mode.", log)
+    try:
+        reference = translate_codon_alignment(reference_file)
+    except ValueError as e:
+        return False, f"Step-2 alignment is not a codon alignment: {e}"
+    new_records, proteins = codon_translations(new_records, log)
+    if not new_records:
+        shutil.copyfile(reference_file, output_abs)
+        return True, "Success"
+
+    protein_ref, protein_aln = output_abs + ".ref.pep", output_abs + ".pep.aln"
+    try:
+        with open(protein_ref, 'w') as f:
+            for i, (_, protein, _) in enumerate(reference):
+                f.write(format_record(f"r{i}", protein))
+        ok, msg = run_mafft_add(protein_ref, [(f"n{i}", p.replace("*", "X")) for i, p in enumerate(proteins)],
+                                protein_aln, threads=threads, options=['--amino'], keeplength=False)
+        if not ok:
+            return False, msg
+        aligned = dict(read_fasta(protein_aln))
+        with open(output_abs, 'w') as f:
+            for i, (header, _, cds) in enumerate(reference):
+                f.write(format_record(header, back_translate(aligned[f"r{i}"], cds)))
+            for i, (header, seq) in enumerate(new_records):
+                f.write(format_record(header, back_translate(aligned[f"n{i}"], seq)))
+        return True, "Success"
+    except (KeyError, ValueError) as e:
+        return False, f"Back-translation failed: {e}"
+    finally:
+        for temp in (protein_ref, protein_aln):
+            if os.path.exists(temp):
+                os.remove(temp)
+
+def trim_settings(num_seqs, mol_type='c'):
+    """ Trimming rules; b1/b2 are 51% and 85% of the sequences ("relaxed" settings). """
+    b1_val = int(round((51 / 100) * num_seqs))
+    b2_val = int(round((85 / 100) * num_seqs))
+    if b1_val > b2_val: b2_val = b1_val
+    return {'t': mol_type, 'b1': b1_val, 'b2': b2_val, 'b3': 5, 'b4': 10, 'b5': 'h'}
 
-def run_gblocks_safely(aligned_file, output_folder, mol_type='c'):
+def gblocks_params(num_seqs, mol_type='c'):
+    """ Gblocks flags for trim_settings(). """
+    return [f'-{k}={v}' for k, v in trim_settings(num_seqs, mol_type).items()]
+
+def trimmed_paths(aligned_file, output_folder):
+    """ GENE_aligned.fasta -> (trimmed/GENE_aln_tr.fasta, trimmed/GENE_aln_tr.html) """
+    base_name = os.path.splitext(os.path.basename(aligned_file))[0]
+    if base_name.endswith("_aligned"):
+        clean_name = base_name[:-8]
+    else:
+        clean_name = base_name
+    return (os.path.join(output_folder, f"{clean_name}_aln_tr.fasta"),
+            os.path.join(output_folder, f"{clean_name}_aln_tr.html"))
+
+def run_gblocks_safely(aligned_file, output_folder, mol_type='c', log=None):
     """
     1. Creates a temp file with short names.
     2. Runs GBlocks.
     3. Restores original names into *_aln_tr.fasta.
     4. Moves HTML report to trimmed folder as *_aln_tr.html.
+    Progress goes to `log` (a list) when given, else to stdout.
     """
     aligned_abs = os.path.abspath(aligned_file)
 
@@ -110,27 +384,16 @@ def run_gblocks_safely(aligned_file, output_folder, mol_type='c'):
     if num_seqs == 0:
         return False, "Aligned file contains 0 sequences."
 
-    print(f"    -> GBlocks Input: {os.path.basename(aligned_file)} ({num_seqs} sequences)")
-
-    # B. Calculate Parameters
-    b1_val = int(round((51 / 100) * num_seqs))
-    b2_val = int(round((85 / 100) * num_seqs))
-    if b1_val > b2_val: b2_val = b1_val
+    msg = f"    -> GBlocks Input: {os.path.basename(aligned_file)} ({num_seqs} sequences)"
+    if log is None:
+        print(msg)
+    else:
+        log.append(msg)
 
-    # C. Run GBlocks
+    # B + C. Run GBlocks
     # We use extension ".gb"
     result_suffix = ".gb"
-    cmd = [
-        'Gblocks',
-        temp_safe_input,
-        f'-t={mol_type}',
-        f'-b1={b1_val}',
-        f'-b2={b2_val}',
-        '-b3=5',
-        '-b4=10',
-        '-b5=h',
-        f'-e={result_suffix}'
-    ]
+    cmd = ['Gblocks', temp_safe_input] + gblocks_params(num_seqs, mol_type) + [f'-e={result_suffix}']
 
     try:
         proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -143,18 +406,7 @@ def run_gblocks_safely(aligned_file, output_folder, mol_type='c'):
         temp_gblocks_html   = temp_safe_input + result_suffix + ".htm" # e.g., file.temp_safe.gb.htm
 
         if os.path.exists(temp_gblocks_output):
-            # --- NAMING LOGIC ---
-            base_name = os.path.splitext(os.path.basename(aligned_file))[0]
-            if base_name.endswith("_aligned"):
-                clean_name = base_name[:-8]
-            else:
-                clean_name = base_name
-
-            final_fasta_name = f"{clean_name}_aln_tr.fasta"
-            final_html_name = f"{clean_name}_aln_tr.html"
-
-            final_fasta_path = os.path.join(output_folder, final_fasta_name)
-            final_html_path = os.path.join(output_folder, final_html_name)
+            final_fasta_path, final_html_path = trimmed_paths(aligned_file, output_folder)
 
             # --- D. Restore Headers (Save FASTA) ---
             restore_ok, restore_msg = mapper.restore_original_headers(temp_gblocks_output, final_fasta_path)
@@ -194,7 +446,600 @@ def run_gblocks_safely(aligned_file, output_folder, mol_type='c'):
         return False, f"Execution Error: {e}"
 
 # ==========================================
-# 3. MAIN PIPELINE
+# 3. CDS QUALITY CONTROL
+# ==========================================
+
+def qc_cds(seqs):
+    """
+    Checks a gene family's CDS at once (frame, internal stops, ambiguous
+    bases, length vs the family median). Returns a list of reasons per
+    sequence; an empty list means the sequence is clean.
+    """
+    if not seqs:
+        return []
+    seqs = [seq.upper() for seq in seqs]
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    # Ambiguous bases: cumulative sums give per-sequence counts without a Python loop
+    data = np.frombuffer("".join(seqs).encode('ascii'), dtype=np.uint8)
+    ambiguous = np.concatenate(([0], np.cumsum(~np.isin(data, np.frombuffer(b"ACGT", dtype=np.uint8)))))
+    n_ambiguous = ambiguous[starts + lengths] - ambiguous[starts]
+
+    # Internal stops: every in-frame codon except the last one
+    n_codons = lengths // 3
+    in_frame = "".join(seq[:3 * n] for seq, n in zip(seqs, n_codons)).encode('ascii')
+    stops = is_stop_codon(np.frombuffer(in_frame, dtype=np.uint8).reshape(-1, 3))
+    stops = np.concatenate(([0], np.cumsum(stops)))
+    codon_starts = np.concatenate(([0], np.cumsum(n_codons)[:-1]))
+    n_internal = stops[codon_starts + np.maximum(n_codons - 1, 0)] - stops[codon_starts]
+
+    median = float(np.median(lengths[lengths > 0])) if (lengths > 0).any() else 0.0
+    low, high = QC_LENGTH_RANGE
+    reasons = []
+    for length, amb, internal in zip(lengths.tolist(), n_ambiguous.tolist(), n_internal.tolist()):
+        why = []
+        if length == 0:
+            why.append("empty")
+        else:
+            if length % 3:
+                why.append(f"length {length} not a multiple of 3")
+            if internal:
+                why.append(f"{internal} internal stop codon(s)")
+            if amb > QC_MAX_AMBIGUOUS * length:
+                why.append(f"{amb / length:.0%} ambiguous bases")
+            if length < low * median or length > high * median:
+                why.append(f"length outlier ({length} vs median {median:.0f})")
+        reasons.append(why)
+    return reasons
+
+QC_TAG = " | QC: "
+
+def run_cds_qc(input_file, qc_dir, base_name):
+    """
+    Filters a downloaded family in place: input_file keeps the sequences
+    passing qc_cds(), the others go to qc_dir/<base>_rejected.fasta with
+    their reasons appended to the header. Earlier rejects are checked again
+    with the file (same family median, and a sequence that now passes is
+    put back), so re-running gives the same split.
+    Returns (True, (input_file, n_rejected, n_total)) or (False, msg).
+    """
+    if np is None:
+        return False, "NumPy is required for CDS_QC."
+    rejected_path = os.path.join(qc_dir, f"{base_name}_rejected.fasta")
+    try:
+        records = list(read_fasta(input_file))
+        earlier = []
+        if os.path.exists(rejected_path):
+            present = {seq_id(header) for header, _ in records}
+            for header, seq in read_fasta(rejected_path):
+                header = header.rsplit(QC_TAG, 1)[0]
+                if seq_id(header) not in present:
+                    earlier.append((header, seq))
+    except OSError as e:
+        return False, f"Error reading sequences: {e}"
+
+    family = records + earlier
+    reasons = qc_cds([seq for _, seq in family])
+    clean = [record for record, why in zip(family, reasons) if not why]
+    rejected = [(f"{header}{QC_TAG}{'; '.join(why)}", seq) for (header, seq), why in zip(family, reasons) if why]
+    try:
+        if clean != records:
+            tmp = input_file + ".part"
+            with open(tmp, 'w') as f:
+                for header, seq in clean:
+                    f.write(format_record(header, seq))
+            os.replace(tmp, input_file)
+        if rejected:
+            with open(rejected_path, 'w') as f:
+                for header, seq in rejected:
+                    f.write(format_record(header, seq))
+        elif os.path.exists(rejected_path):
+            os.remove(rejected_path)
+    except OSError as e:
+        return False, f"Error writing QC results: {e}"
+    return True, (input_file, len(rejected), len(family))
+
+# ==========================================
+# 4. MAFFT STRATEGY SELECTION
+# ==========================================
+# Most accurate first: (name, MAFFT options, largest family it is used for,
+# default cost model). Predicted CPU seconds = coef * n_seqs**a * length**b.
+MAFFT_STRATEGIES = [
+    ("L-INS-i",  ['--localpair', '--maxiterate', '1000'], 200,   (2e-9, 2.0, 2.0)),
+    ("FFT-NS-i", ['--retree', '2', '--maxiterate', '2'],   2000,  (2e-7, 2.0, 1.0)),
+    ("FFT-NS-2", ['--retree', '2', '--maxiterate', '0'],   20000, (5e-8, 2.0, 1.0)),
+    ("PartTree", ['--parttree', '--retree', '1'],          None,  (5e-6, 1.1, 1.0)),
+]
+MIN_FIT_POINTS = 8  # Runs needed before the exponents are refitted (else only coef is rescaled)
+RUNTIME_COLUMNS = ["gene", "strategy", "n_seqs", "length", "threads", "predicted_s", "actual_s", "status"]
+
+def sequence_stats(path):
+    """ (number of sequences, longest sequence) """
+    n_seqs, longest = 0, 0
+    for _, seq in read_fasta(path):
+        n_seqs += 1
+        longest = max(longest, len(seq))
+    return n_seqs, longest
+
+class MafftCostModel:
+    """
+    Runtime model per strategy, calibrated from RUNTIMES_FILE (earlier runs),
+    and the log of predicted vs actual runtimes for this run.
+    """
+    def __init__(self, runtimes_file):
+        self.path = runtimes_file
+        self.lock = threading.Lock()
+        self.params = {name: model for name, _, _, model in MAFFT_STRATEGIES}
+        self.calibrated = {}
+        self.session = []
+        self.calibrate()
+
+    def calibrate(self):
+        points = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', newline='') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    try:
+                        if row["status"] == "ok" and row["strategy"] in self.params and float(row["actual_s"]) > 0:
+                            # CPU seconds ~ wall time x threads
+                            points.setdefault(row["strategy"], []).append(
+                                (int(row["n_seqs"]), int(row["length"]), float(row["actual_s"]) * int(row["threads"])))
+                    except (KeyError, ValueError):
+                        continue
+
+        for name, runs in points.items():
+            coef, a, b = self.params[name]
+            runs = [(n, l, t) for n, l, t in runs if n > 0 and l > 0]
+            if not runs:
+                continue
+            if np is not None and len(runs) >= MIN_FIT_POINTS:
+                # log t = log coef + a log n + b log L
+                data = np.log(np.array(runs, dtype=float))
+                design = np.column_stack([np.ones(len(runs)), data[:, 0], data[:, 1]])
+                solution, _, rank, _ = np.linalg.lstsq(design, data[:, 2], rcond=None)
+                if rank == 3 and 0.5 <= solution[1] <= 3 and 0.5 <= solution[2] <= 3:
+                    self.params[name] = (float(np.exp(solution[0])), float(solution[1]), float(solution[2]))
+                    self.calibrated[name] = len(runs)
+                    continue
+            ratios = sorted(t / (n ** a * l ** b) for n, l, t in runs)
+            self.params[name] = (ratios[len(ratios) // 2], a, b)
+            self.calibrated[name] = len(runs)
+
+    def predict(self, name, n_seqs, length, threads=1):
+        """ Predicted wall seconds. """
+        coef, a, b = self.params[name]
+        return coef * n_seqs ** a * length ** b / max(threads, 1)
+
+    def choose(self, n_seqs, length, threads=1):
+        """ Index of the most accurate usable strategy predicted to meet STRATEGY_TARGET_SECONDS. """
+        usable = [i for i, (_, _, max_seqs, _) in enumerate(MAFFT_STRATEGIES) if max_seqs is None or n_seqs <= max_seqs]
+        for i in usable:
+            if self.predict(MAFFT_STRATEGIES[i][0], n_seqs, length, threads) <= STRATEGY_TARGET_SECONDS:
+                return i
+        return usable[-1]
+
+    def record(self, gene, name, n_seqs, length, threads, predicted, actual, status):
+        row = [gene, name, n_seqs, length, threads, f"{predicted:.3f}", f"{actual:.3f}", status]
+        with self.lock:
+            self.session.append((name, predicted, actual, status))
+            new_file = not os.path.exists(self.path)
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+                if new_file:
+                    writer.writerow(RUNTIME_COLUMNS)
+                writer.writerow(row)
+
+    def summary(self):
+        parts = []
+        for name, _, _, _ in MAFFT_STRATEGIES:
+            runs = [(p, a) for n, p, a, status in self.session if n == name and status == "ok"]
+            if runs:
+                ratio = sum(a for _, a in runs) / max(sum(p for p, _ in runs), 1e-9)
+                parts.append(f"{name} x{len(runs)} (actual/predicted {ratio:.2f})")
+        timeouts = sum(1 for *_, status in self.session if status == "timeout")
+        return (f"MAFFT strategies: {', '.join(parts) or 'none run'}; {timeouts} timeout(s). "
+                f"Runtimes logged to {self.path}")
+
+def strategy_index(model, n_seqs, length, threads):
+    """ Starting strategy for a gene: from the cost model, or the fixed MAFFT_STRATEGY. """
+    if MAFFT_STRATEGY == "adaptive":
+        return model.choose(n_seqs, length, threads)
+    return [name for name, _, _, _ in MAFFT_STRATEGIES].index(MAFFT_STRATEGY)
+
+def run_mafft_strategies(input_file, output_file, start, n_seqs, length, model, threads=1, log=None, gene=None,
+                         extra_options=()):
+    """
+    Runs MAFFT_STRATEGIES[start] and, after a timeout, the next faster ones,
+    all within one MAFFT_TIME_BUDGET deadline per gene. Each attempt gets the
+    time left minus MIN_ATTEMPT_SECONDS for every faster strategy after it.
+    Every attempt is recorded; a strategy reached after the deadline is
+    recorded as a timeout without running. extra_options (e.g. --amino) are
+    added to every strategy.
+    """
+    gene = gene or os.path.splitext(os.path.basename(input_file))[0]
+    deadline = time.perf_counter() + MAFFT_TIME_BUDGET
+    attempts = MAFFT_STRATEGIES[start:]
+    for i, (name, options, _, _) in enumerate(attempts):
+        predicted = model.predict(name, n_seqs, length, threads)
+        started = time.perf_counter()
+        remaining = deadline - started
+        if remaining <= 0:
+            model.record(gene, name, n_seqs, length, threads, predicted, 0.0, "timeout")
+            _say(f"    -> {name}: not started, the {MAFFT_TIME_BUDGET}s budget is used up", log)
+            break
+        reserve = MIN_ATTEMPT_SECONDS * (len(attempts) - i - 1)
+        ok, msg = run_mafft(input_file, output_file, threads=threads, options=options + list(extra_options),
+                            timeout=min(remaining, max(remaining - reserve, MIN_ATTEMPT_SECONDS)))
+        elapsed = time.perf_counter() - started
+        status = "ok" if ok else ("timeout" if msg == MAFFT_TIMEOUT else "error")
+        model.record(gene, name, n_seqs, length, threads, predicted, elapsed, status)
+        msg_line = f"    -> {name}: predicted {predicted:.1f}s, took {elapsed:.1f}s"
+        if log is None:
+            print(msg_line)
+        else:
+            log.append(msg_line + ("" if ok else f" ({status})"))
+        if status != "timeout":
+            return ok, msg
+    return False, (f"No strategy from {MAFFT_STRATEGIES[start][0]} on finished within the "
+                   f"{MAFFT_TIME_BUDGET}s budget.")
+
+# ==========================================
+# 5. NATIVE TRIMMER (experimental: Gblocks' documented rules on a NumPy matrix)
+# ==========================================
+NATIVE_TRIMMER_VERSION = "2"
+# Set to True only once `--compare-trimmers fixtures/gblocks` reports every fixture
+# identical to its committed Gblocks 0.91b output (*_aligned.fasta.gb)
+NATIVE_TRIMMER_VALIDATED = False
+
+def _runs(mask):
+    """ (start, end) index pairs (end exclusive) of the True runs in a 1-D bool array. """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+def native_trim_columns(aln, t='c', b1=0, b2=0, b3=5, b4=10, b5='h'):
+    """
+    Boolean mask of the columns selected by Gblocks' documented procedure:
+    1. a position is conserved if >= b1 sequences share its residue,
+       highly conserved (flank) if >= b2 do; gap positions are those with
+       gaps (b5: n = any gap, h = half or more gaps, a = none);
+    2. stretches of contiguous nonconserved positions longer than b3 are rejected;
+    3. the remaining blocks are trimmed until both flanks are highly conserved;
+    4. gap positions are removed, with the nonconserved positions next to them;
+    5. blocks shorter than b4 positions are rejected.
+    With t='c' whole codons are classified by their least conserved position.
+    """
+    n, length = aln.n_seqs, aln.length
+    best = aln.residue_counts()
+    level = np.where(best >= b2, 2, np.where(best >= b1, 1, 0))
+
+    gap_count = aln.gap_counts()
+    if b5 == 'n':
+        gap_pos = gap_count > 0
+    elif b5 == 'h':
+        gap_pos = gap_count * 2 >= n
+    else:
+        gap_pos = np.zeros(length, dtype=bool)
+
+    unit = 3 if t == 'c' else 1
+    units = length // unit
+    level = level[:units * unit].reshape(units, unit).min(axis=1)
+    gap_pos = gap_pos[:units * unit].reshape(units, unit).any(axis=1)
+
+    # 2. Long nonconserved stretches
+    keep = np.ones(units, dtype=bool)
+    for start, end in _runs(level == 0):
+        if (end - start) * unit > b3:
+            keep[start:end] = False
+
+    # 3. Block flanks must be highly conserved (gap positions don't split blocks yet)
+    blocks = np.zeros(units, dtype=bool)
+    for start, end in _runs(keep):
+        flanks = np.flatnonzero(level[start:end] == 2)
+        if len(flanks):
+            blocks[start + flanks[0]:start + flanks[-1] + 1] = True
+
+    # 4. Gap positions and the nonconserved runs touching them; conserved neighbours stay
+    blocks &= ~gap_pos
+    for start, end in _runs(level == 0):
+        if gap_pos[max(start - 1, 0):min(end + 1, units)].any():
+            blocks[start:end] = False
+
+    # 5. Short blocks
+    selected = np.zeros(units, dtype=bool)
+    for start, end in _runs(blocks):
+        if (end - start) * unit >= b4:
+            selected[start:end] = True
+
+    columns = np.zeros(length, dtype=bool)
+    columns[:units * unit] = np.repeat(selected, unit)
+    return columns
+
+def run_native_trimmer(aligned_file, output_folder, mol_type='c', log=None):
+    """ Trims in memory with native_trim_columns() and writes *_aln_tr.fasta. """
+    if np is None:
+        return False, "NumPy is required for TRIMMER = 'native'."
+    try:
+        aln = Alignment.from_fasta(aligned_file)
+    except (OSError, ValueError) as e:
+        return False, f"Error reading alignment: {e}"
+    if aln.n_seqs == 0:
+        return False, "Aligned file contains 0 sequences."
+
+    columns = native_trim_columns(aln, **trim_settings(aln.n_seqs, mol_type))
+    msg = (f"    -> Native trimmer: {os.path.basename(aligned_file)} ({aln.n_seqs} sequences, "
+           f"kept {int(columns.sum())} of {aln.length} positions)")
+    if log is None:
+        print(msg)
+    else:
+        log.append(msg)
+
+    try:
+        aln.select_columns(columns).write_fasta(trimmed_paths(aligned_file, output_folder)[0])
+    except OSError as e:
+        return False, f"Error writing trimmed file: {e}"
+    return True, "Success"
+
+def kept_columns(aln, trimmed):
+    """ Recovers which columns of `aln` survive in `trimmed` (greedy, in order). """
+    matrix, trimmed = aln.matrix, trimmed.matrix
+    kept = np.zeros(matrix.shape[1], dtype=bool)
+    j = 0
+    for i in range(matrix.shape[1]):
+        if j < trimmed.shape[1] and np.array_equal(matrix[:, i], trimmed[:, j]):
+            kept[i] = True
+            j += 1
+    return kept
+
+def compare_trimmers(aligned_dir, mol_type='c'):
+    """
+    Validation: trims every alignment in aligned_dir with Gblocks and with
+    the native trimmer and reports per-file column agreement. A Gblocks
+    output saved next to an alignment (<name>.gb, as in fixtures/gblocks)
+    is used as is, so the check also runs where Gblocks is not installed.
+    Returns True only if every alignment was compared and trimmed identically.
+    """
+    files = sorted(f for f in os.listdir(aligned_dir) if f.endswith("_aligned.fasta"))
+    print(f"{'alignment':<40}{'length':>8}{'gblocks':>9}{'native':>8}{'both':>7}{'agree%':>8}")
+    identical = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in files:
+            path = os.path.join(aligned_dir, name)
+            saved = path + ".gb"
+            if os.path.exists(saved):
+                gb_path = saved
+            else:
+                shutil.copy(path, os.path.join(tmp, name))
+                ok, msg = run_gblocks_safely(os.path.join(tmp, name), tmp, mol_type=mol_type, log=[])
+                if not ok:
+                    print(f"{name:<40} no {name}.gb and Gblocks failed: {msg}")
+                    continue
+                gb_path = trimmed_paths(name, tmp)[0]
+            aln = Alignment.from_fasta(path)
+            gb = kept_columns(aln, Alignment.from_fasta(gb_path))
+            native = native_trim_columns(aln, **trim_settings(aln.n_seqs, mol_type))
+            agree = 100.0 * (gb == native).mean() if len(gb) else 100.0
+            identical += bool((gb == native).all())
+            print(f"{name:<40}{aln.length:>8}{int(gb.sum()):>9}{int(native.sum()):>8}"
+                  f"{int((gb & native).sum()):>7}{agree:>8.1f}")
+            differ = np.flatnonzero(gb != native) + 1
+            if len(differ):
+                shown = ", ".join(str(c) for c in differ[:20]) + (" ..." if len(differ) > 20 else "")
+                print(f"    differing columns (1-based): {shown}")
+    print(f"{identical}/{len(files)} alignments trimmed identically.")
+    return bool(files) and identical == len(files)
+
+# ==========================================
+# 6. SKIP CACHE
+# ==========================================
+
+def fasta_digest(path):
+    """ SHA-256 of the headers and sequences, independent of line wrapping. """
+    h = hashlib.sha256()
+    for header, seq in read_fasta(path):
+        h.update(b"\n>" + header.encode() + b"\n" + seq.encode())
+    return h.hexdigest()
+
+_TOOL_VERSIONS = {}
+
+def tool_version(tool):
+    """
+    MAFFT reports its version with --version; Gblocks has no such flag,
+    so the executable's own hash stands in for it.
+    """
+    if tool not in _TOOL_VERSIONS:
+        version = None
+        try:
+            if tool == 'mafft':
+                proc = subprocess.run(['mafft', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                version = (proc.stdout + proc.stderr).strip()
+            else:
+                exe = shutil.which(tool)
+                version = file_digest(exe) if exe else None
+        except OSError:
+            pass
+        _TOOL_VERSIONS[tool] = version
+    return _TOOL_VERSIONS[tool]
+
+class SkipCache(DigestManifest):
+    """
+    Manifest of output file -> (job key, output hash). A job whose key
+    (input sequences + tool version + parameters) and output file are
+    unchanged since it was recorded is not run again. Also counts skipped
+    and recomputed jobs for the summary.
+    """
+    def __init__(self, manifest_path, enabled=True):
+        super().__init__(manifest_path, enabled)
+        self.counts = {}
+
+    def count(self, step, skipped):
+        with self.lock:
+            label = (step, "skipped" if skipped else "recomputed")
+            self.counts[label] = self.counts.get(label, 0) + 1
+
+    def summary(self):
+        parts = []
+        for step in ("Alignment", "Trimming"):
+            parts.append(f"{step}: {self.counts.get((step, 'skipped'), 0)} skipped, "
+                         f"{self.counts.get((step, 'recomputed'), 0)} recomputed")
+        return " | ".join(parts)
+
+# ==========================================
+# 7. SCHEDULER
+# ==========================================
+
+class CoreBudget:
+    """ Counting semaphore over cores: a job takes as many as it will use. """
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.total)
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+def count_sequences(path):
+    with open(path, 'r') as f:
+        return sum(1 for line in f if line.startswith(">"))
+
+def mafft_threads(num_seqs, budget):
+    """ Bigger families get more MAFFT threads, within the per-job and total limits. """
+    return max(1, min(MAX_THREADS_PER_JOB, budget, num_seqs // SEQS_PER_THREAD))
+
+def align_and_trim(filename, input_folder, aligned_dir, trimmed_dir, mol_type, threads, cores, cache,
+                   reference=None, model=None):
+    """
+    Aligns and trims one file. Returns its log lines so parallel jobs
+    print as whole blocks instead of interleaving. With a `reference`
+    (step-2 alignment of the same gene) only the new sequences are added;
+    with a cost `model` the MAFFT strategy is chosen per gene.
+    """
+    input_path = os.path.join(input_folder, filename)
+    base_name = os.path.splitext(filename)[0]
+    aligned_path = os.path.join(aligned_dir, f"{base_name}_aligned.fasta")
+    log = [f"Processing: {filename}"]
+
+    # 0. CDS QC (only clean sequences are aligned)
+    if CDS_QC:
+        qc_ok, result = run_cds_qc(input_path, os.path.join(input_folder, "qc"), base_name)
+        if not qc_ok:
+            log.append(f"  0. CDS QC... FAILED. {result}")
+            return log
+        input_path, n_rejected, n_total = result
+        if n_rejected == n_total:
+            log.append(f"  0. CDS QC... all {n_total} sequences rejected (qc/{base_name}_rejected.fasta).")
+            return log
+        note = f" (see qc/{base_name}_rejected.fasta)" if n_rejected else ""
+        log.append(f"  0. CDS QC... {n_rejected} of {n_total} sequences rejected{note}.")
+
+    # 1. ALIGN (holds `threads` cores)
+    codon = ALIGN_MODE == "codon"
+    new_records = None
+    if reference:
+        new_records, reason = plan_incremental(input_path, reference)
+        if new_records is not None and codon and np is not None:
+            try:
+                translate_codon_alignment(reference)
+            except ValueError as e:
+                new_records, reason = None, f"not a codon alignment: {e}"
+        if new_records is None:
+            log.append(f"  1. Step-2 alignment not reusable ({reason}); aligning from scratch.")
+
+    start = None
+    if new_records is None and model is not None:
+        n_seqs, length = sequence_stats(input_path)
+        if codon:
+            length //= 3  # the proteins are what MAFFT aligns
+        start = strategy_index(model, n_seqs, length, threads)
+
+    key = None
+    if cache.enabled and tool_version('mafft'):
+        if new_records is None:
+            options = MAFFT_OPTIONS if start is None else [MAFFT_STRATEGIES[start][1], MAFFT_TIME_BUDGET]
+            if codon:
+                options = ["codon", "--amino", options]
+            key = cache.make_key("mafft", tool_version('mafft'), options, fasta_digest(input_path))
+        else:
+            key = cache.make_key("mafft-add", tool_version('mafft'), ADD_MODE, ADD_KEEPLENGTH, codon,
+                                 fasta_digest(reference), fasta_digest(input_path))
+    if cache.is_fresh(aligned_path, key):
+        cache.count("Alignment", skipped=True)
+        log.append("  1. Aligning... Skipped (unchanged).")
+    else:
+        # Codon mode aligns the translations: don't leave the sequence type to MAFFT's guess
+        extra = ['--amino'] if codon else []
+
+        def align(src, dst):
+            if start is not None:
+                return run_mafft_strategies(src, dst, start, n_seqs, length, model,
+                                            threads=threads, log=log, gene=base_name, extra_options=extra)
+            return run_mafft(src, dst, threads=threads, options=MAFFT_OPTIONS + extra)
+
+        if new_records is None:
+            strategy = "" if start is None else f", {MAFFT_STRATEGIES[start][0]}"
+            step = f"Aligning ({threads} thread(s){strategy}{', codon mode' if codon else ''})"
+        else:
+            step = (f"Adding {len(new_records)} sequence(s) to {os.path.basename(reference)} "
+                    f"(--{ADD_MODE}{', codon mode' if codon else ''})")
+        cores.acquire(threads)
+        try:
+            if new_records is not None and codon:
+                mafft_ok, mafft_msg = run_codon_add(reference, new_records, aligned_path, threads=threads, log=log)
+            elif new_records is not None:
+                mafft_ok, mafft_msg = run_mafft_add(reference, new_records, aligned_path, threads=threads)
+            elif codon:
+                mafft_ok, mafft_msg = run_codon_alignment(input_path, aligned_path, align, log=log)
+            else:
+                mafft_ok, mafft_msg = align(input_path, aligned_path)
+        finally:
+            cores.release(threads)
+        if not mafft_ok:
+            log.append(f"  1. {step}... FAILED. {mafft_msg}")
+            return log
+        cache.record(aligned_path, key)
+        cache.count("Alignment", skipped=False)
+        log.append(f"  1. {step}... Done.")
+
+    # 2. TRIM (single-threaded, either engine)
+    native = TRIMMER == "native"
+    trimmed_path = trimmed_paths(aligned_path, trimmed_dir)[0]
+    key = None
+    if cache.enabled:
+        params = gblocks_params(count_sequences(aligned_path), mol_type)
+        version = f"native-{NATIVE_TRIMMER_VERSION}" if native else tool_version('Gblocks')
+        if version:
+            key = cache.make_key("gblocks", version, params, fasta_digest(aligned_path))
+    if cache.is_fresh(trimmed_path, key):
+        cache.count("Trimming", skipped=True)
+        log.append("  2. Trimming... Skipped (unchanged).")
+        return log
+    cores.acquire(1)
+    try:
+        trimmer = run_native_trimmer if native else run_gblocks_safely
+        gb_ok, gb_msg = trimmer(aligned_path, trimmed_dir, mol_type=mol_type, log=log)
+    finally:
+        cores.release(1)
+    if gb_ok:
+        cache.record(trimmed_path, key)
+        cache.count("Trimming", skipped=False)
+        saved = "*_aln_tr.fasta" if native else "*_aln_tr.fasta & *.html"
+        log.append(f"  2. Trimming... Done. Saved to 'trimmed/' ({saved})")
+    else:
+        log.append(f"  2. Trimming... FAILED. {gb_msg}")
+    return log
+
+# ==========================================
+# 8. MAIN PIPELINE
 # ==========================================
 
 def batch_process():
@@ -202,11 +1047,18 @@ def batch_process():
     INPUT_FOLDER = "."
     MOLECULE_TYPE = "c"  # c = Codons
 
+    if TRIMMER == "native" and not NATIVE_TRIMMER_VALIDATED:
+        if not ALLOW_UNVALIDATED_TRIMMER:
+            print("[X] TRIMMER=native is not validated against Gblocks yet (see fixtures/gblocks/README.md).\n"
+                  "    Use the default Gblocks trimmer, or set ALLOW_UNVALIDATED_TRIMMER=1 to run it anyway.")
+            sys.exit(1)
+        print("[!] TRIMMER=native is experimental: trimmed files may differ from Gblocks'.")
+
     # Setup Folders
     aligned_dir = os.path.join(INPUT_FOLDER, "aligned")
     trimmed_dir = os.path.join(INPUT_FOLDER, "trimmed")
 
-    for d in [aligned_dir, trimmed_dir]:
+    for d in [aligned_dir, trimmed_dir] + ([os.path.join(INPUT_FOLDER, "qc")] if CDS_QC else []):
         if not os.path.exists(d): os.makedirs(d)
 
     # Find Files
@@ -220,38 +1072,62 @@ def batch_process():
         print("No .fasta files found.")
         return
 
-    print(f"Found {len(fasta_files)} FASTA files. Processing...")
-    print("-" * 60)
-
+    # Largest first (file size ~ sequences x length), so big families don't start last
+    budget = max(1, CORE_BUDGET)
+    jobs = []
     for filename in fasta_files:
-        input_path = os.path.join(INPUT_FOLDER, filename)
-        base_name = os.path.splitext(filename)[0]
-
-        # 1. ALIGN
-        aligned_filename = f"{base_name}_aligned.fasta"
-        aligned_path = os.path.join(aligned_dir, aligned_filename)
+        path = os.path.join(INPUT_FOLDER, filename)
+        jobs.append((os.path.getsize(path), filename, mafft_threads(count_sequences(path), budget)))
+    jobs.sort(reverse=True)
 
-        print(f"Processing: {filename}")
-        print(f"  1. Aligning...", end=" ", flush=True)
+    print(f"Found {len(fasta_files)} FASTA files. Processing with a budget of {budget} core(s)...")
+    print("-" * 60)
 
-        mafft_ok, mafft_msg = run_mafft(input_path, aligned_path)
+    # Step-2 alignments to extend instead of realigning (step 6)
+    references = {}
+    if REFERENCE_ALIGNED_DIR:
+        for f in os.listdir(REFERENCE_ALIGNED_DIR):
+            if f.endswith("_aligned.fasta"):
+                references[base_identifier(f)] = os.path.join(REFERENCE_ALIGNED_DIR, f)
+        print(f"Incremental mode: {len(references)} step-2 alignments in {REFERENCE_ALIGNED_DIR}")
 
-        if not mafft_ok:
-            print(f"FAILED. {mafft_msg}")
-            continue
-        print("Done.")
+    model = None
+    if MAFFT_STRATEGY != "auto":
+        known = [name for name, _, _, _ in MAFFT_STRATEGIES]
+        if MAFFT_STRATEGY != "adaptive" and MAFFT_STRATEGY not in known:
+            print(f"Unknown MAFFT_STRATEGY '{MAFFT_STRATEGY}'. Use auto, adaptive or one of: {', '.join(known)}")
+            return
+        model = MafftCostModel(os.path.join(INPUT_FOLDER, RUNTIMES_FILE))
+        if model.calibrated:
+            fitted = ", ".join(f"{name} ({n} runs)" for name, n in model.calibrated.items())
+            print(f"Cost model calibrated from {RUNTIMES_FILE}: {fitted}")
 
-        # 2. TRIM
-        print(f"  2. Trimming...", end="\n", flush=True)
+    cores = CoreBudget(budget)
+    cache = SkipCache(os.path.join(INPUT_FOLDER, CACHE_MANIFEST), enabled=USE_SKIP_CACHE)
+    print_lock = threading.Lock()
 
-        gb_ok, gb_msg = run_gblocks_safely(aligned_path, trimmed_dir, mol_type=MOLECULE_TYPE)
+    def run_job(filename, threads):
+        try:
+            log = align_and_trim(filename, INPUT_FOLDER, aligned_dir, trimmed_dir, MOLECULE_TYPE, threads, cores, cache,
+                                 reference=references.get(base_identifier(filename)), model=model)
+        except Exception as e:
+            log = [f"Processing: {filename}", f"  FAILED. {e}"]
+        with print_lock:
+            print("\n".join(log))
+            print("-" * 60, flush=True)
 
-        if gb_ok:
-            print("     -> Done. Saved to 'trimmed/' (*_aln_tr.fasta & *.html)")
-        else:
-            print(f"     -> FAILED. {gb_msg}")
+    with ThreadPoolExecutor(max_workers=budget) as pool:
+        for _, filename, threads in jobs:
+            pool.submit(run_job, filename, threads)
 
-        print("-" * 60)
+    if cache.enabled:
+        print(cache.summary())
+    if model is not None:
+        print(model.summary())
 
 if __name__ == "__main__":
-    batch_process()
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare-trimmers":
+        # python3 2_6_align_and_trim.py --compare-trimmers [aligned_dir]
+        sys.exit(0 if compare_trimmers(sys.argv[2] if len(sys.argv) > 2 else "aligned") else 1)
+    else:
+        batch_process()
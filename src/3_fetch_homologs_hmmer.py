@@ -2,43 +2,75 @@ import os
 import subprocess
 import sys
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from alignment import DigestManifest, FastaIndex, file_digest, format_record, reverse_complement
+
+# --- CONFIGURATION ---
+# "per-gene": one nhmmer run per profile (each run rescans the whole assembly)
+# "batch": all profiles are pressed into one database and the assembly is scanned
+#          once with nhmmscan; the combined table is split into the per-gene files
+SEARCH_MODE = os.environ.get("HMMER_SEARCH_MODE", "per-gene")
+PROFILE_DB_NAME = "all_profiles.hmmdb"   # Written in the profile folder (batch mode)
+SCAN_TABLE_NAME = "nhmmscan_all.tblout"  # Combined batch table, written in the results folder
+# Worker pool: genes are processed concurrently within HMMER_CORES cores and every
+# hmmbuild/nhmmer gets --cpu HMMER_CPU_PER_JOB (HMMER_CORES // HMMER_CPU_PER_JOB jobs at once)
+HMMER_CORES = int(os.environ.get("HMMER_CORES", os.cpu_count() or 1))
+HMMER_CPU_PER_JOB = int(os.environ.get("HMMER_CPU_PER_JOB", "2"))
+TIMINGS_FILE = "hmmer_timings.tsv"  # Per-gene step timings, written in the results folder
+# Reuse a profile while its alignment (SHA-256 of the file) and the hmmbuild options are unchanged
+USE_PROFILE_CACHE = True
+PROFILE_CACHE_MANIFEST = ".profile_cache.json"  # Written in the profile folder
+HMMBUILD_OPTIONS = ['--dna']  # Assuming DNA since the search is nhmmer
+# "best": whole transcript of the lowest-E-value hit per gene (extract_best_hit)
+# "bulk": after the search, the TOP_K hits per gene covering at least MIN_COVERAGE of the
+#         profile are cut to their envelope (env_from..env_to) in one ordered pass over the
+#         assembly; written to the same <gene>_best_hit.fasta files
+EXTRACT_MODE = os.environ.get("HMMER_EXTRACT_MODE", "best")
+TOP_K = int(os.environ.get("HMMER_TOP_K", "1"))
+MIN_COVERAGE = float(os.environ.get("HMMER_MIN_COVERAGE", "0.5"))  # (hmm_to - hmm_from + 1) / profile LENG
+EXTEND_TO_ORF = os.environ.get("HMMER_EXTEND_TO_ORF", "0") == "1"  # grow the envelope in frame to the flanking stops
+EXTRACTED_TABLE = "extracted_hits.tsv"  # Bulk mode: one row per extracted region (results folder)
+
+def assembly_name(assembly_path):
+    """Assembly file name without extension; names the <assembly>_hits folder"""
+    return os.path.splitext(os.path.basename(assembly_path))[0]
 
 class HmmerPipeline:
-    def __init__(self, assembly_path, evalue=1e-5, bin_path="/home/bin"):
-        self.assembly_path = os.path.abspath(assembly_path)
+    def __init__(self, assembly_paths, evalue=1e-5, bin_path="/home/bin"):
+        # One or more assemblies, searched with the same profiles
+        if isinstance(assembly_paths, str):
+            assembly_paths = [assembly_paths]
         self.evalue = evalue
         self.bin_path = bin_path
-
-        # Load the assembly sequences into memory once (for fast retrieval of best hits)
-        print(f"Loading assembly sequences from {os.path.basename(assembly_path)}...")
-        self.assembly_db = self._load_fasta_db(self.assembly_path)
-        print(f"Loaded {len(self.assembly_db)} sequences.")
-
-    def _load_fasta_db(self, fasta_path):
-        """Helper: Reads the assembly fasta into a dictionary {header: sequence}"""
-        db = {}
-        header = None
-        seq_lines = []
+        self.assemblies = {}    # name -> absolute path
+        self.assembly_dbs = {}  # name -> FastaIndex, opened once and kept for every gene
+
+        # Index each assembly once (<assembly>.fai, reused on later runs); best hits
+        # are read from disk on demand, so memory use doesn't grow with the assembly
+        for path in assembly_paths:
+            name = assembly_name(path)
+            if name in self.assemblies:
+                print(f"Error: two assemblies are named {name}; their results would share {name}_hits")
+                sys.exit(1)
+            print(f"Indexing assembly sequences from {os.path.basename(path)}...")
+            self.assemblies[name] = os.path.abspath(path)
+            self.assembly_dbs[name] = self._open_fasta_index(self.assemblies[name])
+            print(f"Indexed {len(self.assembly_dbs[name])} sequences ({self.assembly_dbs[name].index_path}).")
+
+    def close(self):
+        for db in self.assembly_dbs.values():
+            db.close()
+
+    def _open_fasta_index(self, fasta_path):
+        """Helper: {first word of header: sequence} view of the assembly, backed by a .fai index"""
         try:
-            with open(fasta_path, 'r') as f:
-                for line in f:
-                    if line.startswith(">"):
-                        if header:
-                            # Store previous sequence (take first word of header as key)
-                            key = header.split()[0]
-                            db[key] = "".join(seq_lines)
-                        header = line.strip()[1:] # Remove '>'
-                        seq_lines = []
-                    else:
-                        seq_lines.append(line.strip())
-                # Store last sequence
-                if header:
-                    key = header.split()[0]
-                    db[key] = "".join(seq_lines)
+            return FastaIndex(fasta_path)
         except Exception as e:
-            print(f"Error loading assembly: {e}")
+            print(f"Error indexing assembly: {e}")
             sys.exit(1)
-        return db
 
     def _get_executable(self, tool_name):
         """Constructs path to executable in /home/bin"""
@@ -50,12 +82,16 @@ class HmmerPipeline:
             # Fallback to system path if not in /home/bin
             return tool_name
 
-    def build_hmm_profile(self, aligned_fasta, hmm_output):
+    @staticmethod
+    def _cpu_args(cpu):
+        """--cpu N (worker threads) when a core allocation is given, else HMMER's default"""
+        return ['--cpu', str(cpu)] if cpu else []
+
+    def build_hmm_profile(self, aligned_fasta, hmm_output, cpu=None):
         """Build HMM profile from aligned sequences"""
         hmmbuild_exe = self._get_executable('hmmbuild')
         try:
-            # Assuming DNA since the search is nhmmer
-            cmd = [hmmbuild_exe, '--dna', str(hmm_output), str(aligned_fasta)]
+            cmd = [hmmbuild_exe, *HMMBUILD_OPTIONS, *self._cpu_args(cpu), str(hmm_output), str(aligned_fasta)]
 
             result = subprocess.run(
                 cmd,
@@ -70,16 +106,17 @@ class HmmerPipeline:
         except FileNotFoundError:
             return False, f"hmmbuild not found at {hmmbuild_exe}"
 
-    def run_nhmmer(self, hmm_file, output_tbl):
+    def run_nhmmer(self, hmm_file, output_tbl, assembly, cpu=None):
         """Run nhmmer search (DNA sequences)"""
         nhmmer_exe = self._get_executable('nhmmer')
         try:
             cmd = [
                 nhmmer_exe,
+                *self._cpu_args(cpu),
                 '--tblout', str(output_tbl),
                 '-E', str(self.evalue),
                 str(hmm_file),
-                str(self.assembly_path)
+                str(self.assemblies[assembly])
             ]
 
             result = subprocess.run(
@@ -95,11 +132,123 @@ class HmmerPipeline:
         except FileNotFoundError:
             return False, f"nhmmer not found at {nhmmer_exe}"
 
-    def extract_best_hit(self, tbl_file, output_fasta):
+    # --- Batch mode: one pass over the assembly for all profiles ---
+    def build_profile_db(self, hmm_paths, db_path):
+        """
+        Concatenates the profiles into one database and hmmpress-es it.
+        Returns (ok, msg, {profile NAME: gene}) so scan hits can be mapped back.
+        """
+        profile_genes = {}
+        try:
+            with open(db_path, 'w') as db:
+                for gene, hmm_path in hmm_paths.items():
+                    with open(hmm_path, 'r') as f:
+                        text = f.read()
+                    for line in text.splitlines():
+                        if line.startswith("NAME"):
+                            name = line.split(None, 1)[1].strip()
+                            if name in profile_genes:
+                                return False, f"Profile name {name} is used by {profile_genes[name]} and {gene}", {}
+                            profile_genes[name] = gene
+                    db.write(text)
+        except OSError as e:
+            return False, f"Could not write profile database: {e}", {}
+
+        hmmpress_exe = self._get_executable('hmmpress')
+        try:
+            # -f: overwrite the pressed files of a previous run
+            subprocess.run([hmmpress_exe, '-f', str(db_path)],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+            return True, f"{len(profile_genes)} profiles pressed into {db_path}", profile_genes
+        except subprocess.CalledProcessError as e:
+            return False, f"hmmpress error: {e.stderr}", {}
+        except FileNotFoundError:
+            return False, f"hmmpress not found at {hmmpress_exe}", {}
+
+    def run_nhmmscan(self, db_path, output_tbl, assembly, n_profiles, cpu=None):
+        """
+        Scans every assembly sequence against the pressed database in a single run.
+        nhmmscan scales E-values by the profile count and the length of each
+        sequence instead of the assembly size, so -E is loosened here to keep
+        every hit nhmmer would report; split_scan_table rescales and re-applies it.
+        """
+        nhmmscan_exe = self._get_executable('nhmmscan')
+        assembly_db = self.assembly_dbs[assembly]
+        longest = max((entry[0] for entry in assembly_db.entries.values()), default=1)
+        scan_evalue = self.evalue * max(1.0, n_profiles * longest / max(assembly_db.total_length(), 1))
+        try:
+            cmd = [
+                nhmmscan_exe,
+                *self._cpu_args(cpu),
+                '--tblout', str(output_tbl),
+                '-E', f"{scan_evalue:g}",
+                str(db_path),
+                str(self.assemblies[assembly])
+            ]
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+            return True, "Scan completed"
+        except subprocess.CalledProcessError as e:
+            return False, f"nhmmscan error: {e.stderr}"
+        except FileNotFoundError:
+            return False, f"nhmmscan not found at {nhmmscan_exe}"
+
+    def split_scan_table(self, scan_tbl, profile_genes, tbl_paths, assembly):
+        """
+        Splits the combined nhmmscan table into one nhmmer-style table per gene:
+        nhmmscan lists the profile as target and the assembly sequence as query,
+        so the name columns are swapped back and hits are sorted by E-value.
+        nhmmscan reports the profile length (modlen) where nhmmer has the target
+        sequence length, so "sq len" is taken from the assembly index. E-values
+        are rescaled from nhmmscan's per-sequence search space (profiles x
+        sequence length) to nhmmer's (assembly length) and the -E cutoff is
+        applied to them. Genes without hits get a table with only the header.
+        Returns {gene: n_hits}.
+        """
+        entries = self.assembly_dbs[assembly].entries
+        total_length = self.assembly_dbs[assembly].total_length()
+        n_profiles = max(len(profile_genes), 1)
+        rows = {gene: [] for gene in tbl_paths}
+        with open(scan_tbl, 'r') as f:
+            for line in f:
+                if line.startswith("#"): continue
+                parts = line.split(None, 15)
+                if len(parts) < 15: continue
+                gene = profile_genes.get(parts[0])
+                if gene not in rows: continue
+                parts[0], parts[1], parts[2], parts[3] = parts[2], parts[3], parts[0], parts[1]
+                if parts[0] not in entries: continue
+                seq_length = entries[parts[0]][0]
+                parts[10] = str(seq_length)
+                try:
+                    evalue = float(parts[12]) * total_length / (n_profiles * seq_length)
+                    score = float(parts[13])
+                except ValueError:
+                    continue
+                if evalue > self.evalue: continue
+                parts[12] = "%.2g" % evalue
+                rows[gene].append((evalue, -score, parts))
+
+        # Same column layout as nhmmer --tblout
+        header = ("#target name        accession  query name           accession  hmmfrom hmm to alifrom  ali to "
+                  "envfrom  env to  sq len strand   E-value  score  bias  description of target\n"
+                  "#------------------- ---------- -------------------- ---------- ------- ------- ------- ------- "
+                  "------- ------- ------- ------ --------- ------ ----- ---------------------\n")
+        row_format = "%-20s %-10s %-20s %-10s %7s %7s %7s %7s %7s %7s %7s    %s   %9s %6s %5s  %s\n"
+        for gene, hits in rows.items():
+            hits.sort(key=lambda hit: hit[:2])
+            with open(tbl_paths[gene], 'w') as out:
+                out.write(header)
+                for _, _, parts in hits:
+                    description = parts[15].strip() if len(parts) > 15 else "-"
+                    out.write(row_format % (*parts[:15], description))
+        return {gene: len(hits) for gene, hits in rows.items()}
+
+    def extract_best_hit(self, tbl_file, output_fasta, assembly):
         """
         Parses the --tblout file to find the best hit (lowest E-value).
-        Extracts that sequence from self.assembly_db.
+        Extracts that sequence from the assembly's index.
         """
+        assembly_db = self.assembly_dbs[assembly]
         best_hit_name = None
         best_evalue = float('inf')
 
@@ -125,8 +274,8 @@ class HmmerPipeline:
                         best_hit_name = target_name
 
             if best_hit_name:
-                if best_hit_name in self.assembly_db:
-                    sequence = self.assembly_db[best_hit_name]
+                if best_hit_name in assembly_db:
+                    sequence = assembly_db[best_hit_name]
                     with open(output_fasta, 'w') as outf:
                         outf.write(f">{best_hit_name} [Best Hit E={best_evalue}]\n{sequence}\n")
                     return True, f"Found hit: {best_hit_name} (E={best_evalue})"
@@ -138,39 +287,331 @@ class HmmerPipeline:
         except Exception as e:
             return False, f"Error parsing table: {e}"
 
+# ==========================================
+# BULK EXTRACTION (top-k envelopes)
+# ==========================================
+STOP_CODONS = {"TAA", "TAG", "TGA"}
+
+class BulkExtractor:
+    """
+    Reads every *_hits.tbl of an assembly once, keeps the TOP_K hits per gene
+    (lowest E-value, then highest score) that cover at least MIN_COVERAGE of
+    the profile, and writes only their envelope regions. Regions are cut from
+    the assembly in .fai offset order, so the file is read front to back once.
+    """
+    def __init__(self, assembly_db, hmm_profile_dir, top_k=1, min_coverage=0.0, extend_to_orf=False):
+        self.assembly_db = assembly_db
+        self.hmm_profile_dir = hmm_profile_dir
+        self.top_k = max(1, top_k)
+        self.min_coverage = min_coverage
+        self.extend_to_orf = extend_to_orf
+
+    def profile_length(self, gene):
+        """LENG of the gene's profile (model positions), or None if the .hmm can't be read"""
+        try:
+            with open(os.path.join(self.hmm_profile_dir, f"{gene}.hmm"), 'r') as f:
+                for line in f:
+                    if line.startswith("LENG"):
+                        return int(line.split()[1])
+                    if line.startswith("HMM "):
+                        break
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    @staticmethod
+    def read_hits(tbl_file):
+        """Yields one dict per nhmmer --tblout hit line"""
+        with open(tbl_file, 'r') as f:
+            for line in f:
+                if line.startswith("#"): continue
+                parts = line.split()
+                if len(parts) < 15: continue
+                try:
+                    yield {"target": parts[0], "hmm_from": int(parts[4]), "hmm_to": int(parts[5]),
+                           "ali_from": int(parts[6]), "ali_to": int(parts[7]),
+                           "env_from": int(parts[8]), "env_to": int(parts[9]), "strand": parts[11],
+                           "evalue": float(parts[12]), "score": float(parts[13])}
+                except ValueError:
+                    continue
+
+    def select(self, tbl_paths):
+        """{gene: top-k hits}; each hit gets its profile coverage"""
+        selected = {}
+        for gene, tbl_file in tbl_paths.items():
+            model_length = self.profile_length(gene)
+            if model_length is None and self.min_coverage > 0:
+                print(f"  [!] {gene}: profile length unknown, coverage not checked")
+            hits = []
+            for hit in self.read_hits(tbl_file):
+                hit["coverage"] = (hit["hmm_to"] - hit["hmm_from"] + 1) / model_length if model_length else None
+                if hit["coverage"] is not None and hit["coverage"] < self.min_coverage:
+                    continue
+                hits.append(hit)
+            hits.sort(key=lambda hit: (hit["evalue"], -hit["score"]))
+            selected[gene] = hits[:self.top_k]
+        return selected
+
+    def region(self, hit, sequence):
+        """
+        Envelope of a hit on its own strand as (oriented sequence, start, end), 0-based
+        half-open. With extend_to_orf it is grown codon by codon (in the frame the
+        profile is aligned in) up to, not including, the flanking stop codons.
+        """
+        low, high = sorted((hit["env_from"], hit["env_to"]))
+        if hit["strand"] == "-":
+            oriented = reverse_complement(sequence)
+            start, end = len(sequence) - high, len(sequence) - low + 1
+            ali_start = len(sequence) - hit["ali_from"]
+        else:
+            oriented = sequence
+            start, end = low - 1, high
+            ali_start = hit["ali_from"] - 1
+        if not self.extend_to_orf:
+            return oriented, start, end
+
+        # Model position 1 is the first base of a codon in the trimmed CDS alignment
+        frame = (ali_start - (hit["hmm_from"] - 1)) % 3
+        start -= (start - frame) % 3
+        end += (frame - end) % 3
+        if start < 0:
+            start += 3
+        if end > len(oriented):
+            end -= 3
+        while start >= 3 and oriented[start - 3:start].upper() not in STOP_CODONS:
+            start -= 3
+        while end + 3 <= len(oriented) and oriented[end:end + 3].upper() not in STOP_CODONS:
+            end += 3
+        return oriented, start, end
+
+    def extract(self, selected, results_dir):
+        """
+        Writes <gene>_best_hit.fasta with the selected regions and a table of them.
+        Returns {gene: number of regions written}.
+        """
+        # One ordered pass: every target is read once, in file order
+        targets = {hit["target"] for hits in selected.values() for hit in hits}
+        missing = {target for target in targets if target not in self.assembly_db}
+        order = sorted(targets - missing, key=lambda target: self.assembly_db.entries[target][1])
+        sequences = {target: self.assembly_db[target] for target in order}
+
+        written = {}
+        rows = []
+        for gene, hits in selected.items():
+            records = []
+            for rank, hit in enumerate(hits, 1):
+                if hit["target"] in missing:
+                    print(f"  [!] {gene}: hit {hit['target']} missing in the assembly index")
+                    continue
+                oriented, start, end = self.region(hit, sequences[hit["target"]])
+                # Forward-strand coordinates (1-based) of the region, for the header and table
+                if hit["strand"] == "-":
+                    region_from, region_to = len(oriented) - start, len(oriented) - end + 1
+                else:
+                    region_from, region_to = start + 1, end
+                header = (f"{hit['target']}_{region_from}-{region_to} [Hit {rank} E={hit['evalue']} "
+                          f"strand={hit['strand']} env={hit['env_from']}-{hit['env_to']}]")
+                records.append(format_record(header, oriented[start:end], width=0))
+                coverage = "" if hit["coverage"] is None else f"{hit['coverage']:.3f}"
+                rows.append([gene, rank, hit["target"], hit["strand"], hit["env_from"], hit["env_to"],
+                             region_from, region_to, end - start, hit["evalue"], hit["score"], coverage])
+            if records:
+                with open(os.path.join(results_dir, f"{gene}_best_hit.fasta"), 'w') as f:
+                    f.write("".join(records))
+            written[gene] = len(records)
+
+        with open(os.path.join(results_dir, EXTRACTED_TABLE), 'w') as f:
+            f.write("gene\trank\ttarget\tstrand\tenv_from\tenv_to\tregion_from\tregion_to\tlength\t"
+                    "evalue\tscore\tcoverage\n")
+            for row in rows:
+                f.write("\t".join(str(cell) for cell in row) + "\n")
+        return written
+
 # ==========================================
 # MAIN WORKFLOW
 # ==========================================
+def build_step(pipeline, cache, filename, input_dir, hmm_profile_dir, cpu):
+    """
+    Builds (or reuses from the cache) one gene's profile.
+    Returns (log lines, hmmbuild seconds or None if reused, hmm path or None).
+    """
+    base_name = os.path.splitext(filename)[0]
+    input_path = os.path.join(input_dir, filename)
+    hmm_path = os.path.join(hmm_profile_dir, f"{base_name}.hmm")
+    log = [f"Gene: {base_name}"]
+
+    # Rebuilt only when the alignment or the hmmbuild options change (or the .hmm was modified)
+    key = cache.make_key(file_digest(input_path), HMMBUILD_OPTIONS)
+    if cache.is_fresh(hmm_path, key, name=base_name):
+        log.append("  [V] HMM reused (alignment unchanged)")
+        return log, None, hmm_path
+
+    # --- Step A: Build HMM Profile ---
+    start = time.perf_counter()
+    ok_build, msg_build = pipeline.build_hmm_profile(input_path, hmm_path, cpu=cpu)
+    seconds = time.perf_counter() - start
+
+    if not ok_build:
+        log.append(f"  [X] HMM Build Failed: {msg_build}")
+        return log, seconds, None
+    cache.record(hmm_path, key, name=base_name)
+    log.append(f"  [V] HMM built ({seconds:.1f} s)")
+    return log, seconds, hmm_path
+
+def search_step(pipeline, base_name, hmm_path, assembly, results_dir, cpu, timings, extract=True):
+    """
+    nhmmer search of one profile against one assembly, then best-hit extraction
+    (unless `extract` is False: bulk extraction runs once all genes are searched).
+    Returns (log lines, search ok).
+    """
+    log = [f"Gene: {base_name}"]
+
+    # --- Step B: Run Search (nhmmer) ---
+    tbl_path = os.path.join(results_dir, f"{base_name}_hits.tbl")
+    start = time.perf_counter()
+    ok_search, msg_search = pipeline.run_nhmmer(hmm_path, tbl_path, assembly, cpu=cpu)
+    timings["search"] = time.perf_counter() - start
+
+    if not ok_search:
+        log.append(f"  [X] Search Failed: {msg_search}")
+        return log, False
+
+    # --- Step C: Extract Best Hit ---
+    if extract:
+        log.append(extract_step(pipeline, base_name, tbl_path, assembly, results_dir, timings))
+    else:
+        log.append(f"  [V] {msg_search}")
+    log.append("  Time: " + ", ".join(f"{step} {seconds:.1f} s" for step, seconds in timings.items()))
+    return log, True
+
+def extract_step(pipeline, base_name, tbl_path, assembly, results_dir, timings):
+    hit_fasta_path = os.path.join(results_dir, f"{base_name}_best_hit.fasta")
+    start = time.perf_counter()
+    ok_extract, msg_extract = pipeline.extract_best_hit(tbl_path, hit_fasta_path, assembly)
+    timings["extract"] = time.perf_counter() - start
+    return f"  [V] {msg_extract}" if ok_extract else f"  [-] {msg_extract}"
+
+def write_timings(path, timings, cpu):
+    """ One row per gene: seconds spent in each step and the --cpu it ran with (empty: skipped/reused). """
+    steps = ["hmmbuild", "search", "extract"]
+    with open(path, 'w') as f:
+        f.write("gene\tcpu\t" + "\t".join(f"{step}_s" for step in steps) + "\n")
+        for gene in sorted(timings):
+            cells = [f"{timings[gene][step]:.3f}" if step in timings[gene] else "" for step in steps]
+            f.write(f"{gene}\t{cpu}\t" + "\t".join(cells) + "\n")
+
+def search_assembly(pipeline, assembly, hmm_paths, build_times, hmm_profile_dir, db_path, profile_genes,
+                    cores, cpu, workers):
+    """ Searches every profile against one assembly into <assembly>_hits/. """
+    results_dir = f"{assembly}_hits"
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+
+    print("=" * 60)
+    print(f"Assembly: {assembly} ({len(pipeline.assembly_dbs[assembly])} sequences) -> {results_dir}")
+    print("-" * 60)
+
+    timings = {}
+    for gene, seconds in build_times.items():
+        timings[gene] = {"hmmbuild": seconds} if seconds is not None else {}
+    tbl_paths = {gene: os.path.join(results_dir, f"{gene}_hits.tbl") for gene in hmm_paths}
+    bulk = EXTRACT_MODE == "bulk"
+    searched = set()
+
+    if SEARCH_MODE == "batch":
+        # --- Step B (batch): one nhmmscan pass over the assembly, split per gene ---
+        # The single scan gets every core
+        scan_tbl = os.path.join(results_dir, SCAN_TABLE_NAME)
+        start = time.perf_counter()
+        ok_scan, msg_scan = pipeline.run_nhmmscan(db_path, scan_tbl, assembly, len(profile_genes), cpu=cores)
+        if not ok_scan:
+            print(f"[X] Search Failed: {msg_scan}")
+            return
+        hit_counts = pipeline.split_scan_table(scan_tbl, profile_genes, tbl_paths, assembly)
+        print(f"[V] {msg_scan} in {time.perf_counter() - start:.1f} s (--cpu {cores}): "
+              f"{sum(hit_counts.values())} hits for {len(tbl_paths)} profiles")
+        print("-" * 60)
+        searched.update(tbl_paths)
+
+        # --- Step C: Extract Best Hit ---
+        if not bulk:
+            for gene, tbl_path in tbl_paths.items():
+                print(f"Gene: {gene}")
+                print(extract_step(pipeline, gene, tbl_path, assembly, results_dir, timings[gene]))
+    else:
+        print_lock = threading.Lock()
+
+        def run_job(gene):
+            ok = False
+            try:
+                log, ok = search_step(pipeline, gene, hmm_paths[gene], assembly, results_dir, cpu, timings[gene],
+                                      extract=not bulk)
+            except Exception as e:
+                log = [f"Gene: {gene}", f"  [X] Failed: {e}"]
+            with print_lock:
+                if ok:
+                    searched.add(gene)
+                print("\n".join(log), flush=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for gene in hmm_paths:
+                pool.submit(run_job, gene)
+
+    if bulk:
+        # --- Step C (bulk): top-k envelopes of every searched gene, one pass over the assembly ---
+        print("-" * 60)
+        start = time.perf_counter()
+        extractor = BulkExtractor(pipeline.assembly_dbs[assembly], hmm_profile_dir, top_k=TOP_K,
+                                  min_coverage=MIN_COVERAGE, extend_to_orf=EXTEND_TO_ORF)
+        selected = extractor.select({gene: tbl_paths[gene] for gene in sorted(searched)})
+        written = extractor.extract(selected, results_dir)
+        for gene, n in written.items():
+            print(f"Gene: {gene}")
+            print(f"  [V] {n} region(s) extracted" if n else "  [-] No significant hits passing the coverage cutoff.")
+        print(f"[V] Bulk extraction in {time.perf_counter() - start:.1f} s: {sum(written.values())} regions "
+              f"(top {TOP_K}, coverage >= {MIN_COVERAGE}{', extended to ORF' if EXTEND_TO_ORF else ''}); "
+              f"see {os.path.join(results_dir, EXTRACTED_TABLE)}")
+
+    write_timings(os.path.join(results_dir, TIMINGS_FILE), timings, cpu)
+    slowest = sorted(timings.items(), key=lambda item: -sum(item[1].values()))[:3]
+    if slowest:
+        print("-" * 60)
+        print(f"Per-gene timings in {os.path.join(results_dir, TIMINGS_FILE)}; slowest: "
+              + ", ".join(f"{gene} ({sum(t.values()):.1f} s)" for gene, t in slowest))
+
 def main():
     # --- CONFIGURATION ---
     # Path to the folder containing your aligned/trimmed fasta files
     INPUT_TRIMMED_DIR = "./Downloads/trimmed/"
 
-    # Path to your Transcriptome Assembly Fasta
-    # CHANGE THIS to the actual path of your assembly file
-    ASSEMBLY_FILE = "/run/media/siby/TOSHIBA EXT/Transcriptome_Bini/3.Assembly/SD_trinity.Trinity.cdhit.fasta"
+    # Paths to your Transcriptome Assembly Fastas, all searched with the same profiles
+    # CHANGE THIS to the actual paths of your assembly files (or pass them as arguments:
+    # python3 3_fetch_homologs_hmmer.py DF.fasta HF.fasta SD.fasta)
+    ASSEMBLY_FILES = [
+        "/run/media/siby/TOSHIBA EXT/Transcriptome_Bini/3.Assembly/SD_trinity.Trinity.cdhit.fasta",
+    ]
 
     # =====================
+    if len(sys.argv) > 1:
+        ASSEMBLY_FILES = sys.argv[1:]
 
-    if not os.path.exists(ASSEMBLY_FILE):
-        print(f"Error: Assembly file not found at {ASSEMBLY_FILE}")
+    missing = [path for path in ASSEMBLY_FILES if not os.path.exists(path)]
+    if missing:
+        for path in missing:
+            print(f"Error: Assembly file not found at {path}")
         return
 
-    # 1. Setup Directories
+    # 1. Setup Directories (one <assembly>_hits folder per assembly, named without extension)
     hmm_profile_dir = "hmm_profiles"
     if not os.path.exists(hmm_profile_dir):
         os.makedirs(hmm_profile_dir)
 
-    # Create output folder named after the assembly file (without extension)
-    assembly_name = os.path.splitext(os.path.basename(ASSEMBLY_FILE))[0]
-    results_dir = f"{assembly_name}_hits"
-    if not os.path.exists(results_dir):
-        os.makedirs(results_dir)
-
-    print(f"Output directories:\n  Profiles: {hmm_profile_dir}\n  Results:  {results_dir}\n")
+    results_dirs = ", ".join(f"{assembly_name(path)}_hits" for path in ASSEMBLY_FILES)
+    print(f"Output directories:\n  Profiles: {hmm_profile_dir}\n  Results:  {results_dirs}\n")
 
-    # 2. Initialize Pipeline
-    pipeline = HmmerPipeline(ASSEMBLY_FILE, evalue=1e-5)
+    # 2. Initialize Pipeline (indexes every assembly once)
+    pipeline = HmmerPipeline(ASSEMBLY_FILES, evalue=1e-5)
+    cache = DigestManifest(os.path.join(hmm_profile_dir, PROFILE_CACHE_MANIFEST), enabled=USE_PROFILE_CACHE)
 
     # 3. Process Files
     fasta_files = [f for f in os.listdir(INPUT_TRIMMED_DIR) if f.endswith(".fasta") or f.endswith(".fa")]
@@ -179,40 +620,56 @@ def main():
         print(f"No fasta files found in {INPUT_TRIMMED_DIR}")
         return
 
-    print(f"Processing {len(fasta_files)} alignments...")
+    cores = max(1, HMMER_CORES)
+    cpu = max(1, min(HMMER_CPU_PER_JOB, cores))
+    workers = max(1, cores // cpu)
+    print(f"Processing {len(fasta_files)} alignments against {len(pipeline.assemblies)} assembly(ies) "
+          f"({SEARCH_MODE} search, {workers} job(s) at once with --cpu {cpu})...")
     print("-" * 60)
 
-    for filename in fasta_files:
-        base_name = os.path.splitext(filename)[0]
-        input_path = os.path.join(INPUT_TRIMMED_DIR, filename)
-
-        print(f"Gene: {base_name}")
-
-        # --- Step A: Build HMM Profile ---
-        hmm_path = os.path.join(hmm_profile_dir, f"{base_name}.hmm")
-        ok_build, msg_build = pipeline.build_hmm_profile(input_path, hmm_path)
-
-        if not ok_build:
-            print(f"  [X] HMM Build Failed: {msg_build}")
-            continue
-
-        # --- Step B: Run Search (nhmmer) ---
-        tbl_path = os.path.join(results_dir, f"{base_name}_hits.tbl")
-        ok_search, msg_search = pipeline.run_nhmmer(hmm_path, tbl_path)
-
-        if not ok_search:
-            print(f"  [X] Search Failed: {msg_search}")
-            continue
-
-        # --- Step C: Extract Best Hit ---
-        hit_fasta_path = os.path.join(results_dir, f"{base_name}_best_hit.fasta")
-        ok_extract, msg_extract = pipeline.extract_best_hit(tbl_path, hit_fasta_path)
-
-        if ok_extract:
-            print(f"  [V] {msg_extract}")
-        else:
-            print(f"  [-] {msg_extract}")
+    # Profiles are built (or reused) once and searched against every assembly
+    hmm_paths = {}
+    build_times = {}
+    print_lock = threading.Lock()
 
+    def run_build(filename):
+        base_name = os.path.splitext(filename)[0]
+        try:
+            log, seconds, hmm_path = build_step(pipeline, cache, filename, INPUT_TRIMMED_DIR, hmm_profile_dir, cpu)
+        except Exception as e:
+            log, seconds, hmm_path = [f"Gene: {base_name}", f"  [X] Failed: {e}"], None, None
+        with print_lock:
+            if hmm_path:
+                hmm_paths[base_name] = hmm_path
+                build_times[base_name] = seconds
+            print("\n".join(log), flush=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for filename in fasta_files:
+            pool.submit(run_build, filename)
+
+    reused = sum(1 for seconds in build_times.values() if seconds is None)
+    print("-" * 60)
+    print(f"Profiles: {len(hmm_paths) - reused} built, {reused} reused, "
+          f"{len(fasta_files) - len(hmm_paths)} failed")
+    hmm_paths = dict(sorted(hmm_paths.items()))
+
+    db_path, profile_genes = None, {}
+    if SEARCH_MODE == "batch" and hmm_paths:
+        # One pressed database, scanned by every assembly
+        db_path = os.path.join(hmm_profile_dir, PROFILE_DB_NAME)
+        ok_db, msg_db, profile_genes = pipeline.build_profile_db(hmm_paths, db_path)
+        if not ok_db:
+            print(f"[X] Profile database failed: {msg_db}")
+            return
+        print(f"[V] {msg_db}")
+
+    if hmm_paths:
+        for assembly in pipeline.assemblies:
+            search_assembly(pipeline, assembly, hmm_paths, build_times, hmm_profile_dir, db_path, profile_genes,
+                            cores, cpu, workers)
+
+    pipeline.close()
     print("-" * 60)
     print("Pipeline complete.")
 
@@ -1,6 +1,8 @@
 import os
 import sys
 
+from alignment import read_fasta, format_record
+
 def generate_output_filename(original_filename):
     """
     Creates a new filename based on the first two words of the original file.
@@ -83,30 +85,16 @@ def concatenate_homologs(folder_list, output_dir):
                     suffix = get_folder_suffix(folder)
 
                     try:
-                        with open(source_file_path, 'r') as infile:
-                            for line in infile:
-                                if line.startswith(">"):
-                                    # HEADER MODIFICATION LOGIC
-
-                                    # 1. Strip whitespace
-                                    clean_line = line.strip()
-
-                                    # 2. Remove square brackets info (Take everything before first space or bracket)
-                                    # Example: ">TRINITY... [Best Hit]" -> ">TRINITY..."
-                                    # Using split()[0] effectively grabs just the ID part
-                                    header_id = clean_line.split()[0]
-
-                                    # 3. Construct new header with suffix
-                                    # Output: >TRINITY..._human
-                                    new_header = f"{header_id}_{suffix}\n"
-                                    outfile.write(new_header)
-
-                                else:
-                                    # SEQUENCE LINE
-                                    outfile.write(line)
-
-                            # Ensure newline at end of file to prevent merging
-                            outfile.write('\n')
+                        for header, seq in read_fasta(source_file_path):
+                            # HEADER MODIFICATION LOGIC
+                            # Remove square brackets info (Take everything before first space or bracket)
+                            # Example: ">TRINITY... [Best Hit]" -> ">TRINITY..."
+                            # Using split()[0] effectively grabs just the ID part
+                            header_id = (header.split() or [""])[0]
+
+                            # Construct new header with suffix
+                            # Output: >TRINITY..._human
+                            outfile.write(format_record(f"{header_id}_{suffix}", seq))
 
                     except Exception as e:
                         print(f"  [Error] Reading {source_file_path}: {e}")
@@ -3,33 +3,12 @@ import subprocess
 import shutil
 import sys
 
+from alignment import alignment_length
+
 # ==========================================
 # 1. HELPER FUNCTIONS
 # ==========================================
 
-def get_alignment_length(fasta_path):
-    """
-    Reads the first sequence in the FASTA file to determine alignment length.
-    CORRECTION: Removes spaces (formatting) but counts dashes (gaps) and letters.
-    """
-    seq_len = 0
-    with open(fasta_path, 'r') as f:
-        header_seen = False
-        for line in f:
-            line = line.strip()
-            if line.startswith(">"):
-                if header_seen:
-                    # We reached the next sequence; stop reading.
-                    break
-                header_seen = True
-            else:
-                if header_seen:
-                    # Remove spaces used for visual formatting (e.g. "gatc gatc")
-                    # But KEEP dashes ("-") because they are part of the alignment length
-                    clean_line = line.replace(" ", "")
-                    seq_len += len(clean_line)
-    return seq_len
-
 def create_partition_file(file_path, length):
     """
     Creates a NEXUS/RAxML style partition file for 3 codon positions.
@@ -95,7 +74,7 @@ def run_phylogeny_pipeline(input_folder, output_root):
         shutil.copy2(original_path, dest_fasta_path)
 
         # C. Get Length and Write Partition File
-        aln_len = get_alignment_length(dest_fasta_path)
+        aln_len = alignment_length(dest_fasta_path)
 
         if aln_len == 0:
             print(f"[Skip] {filename} seems empty.")
@@ -0,0 +1,386 @@
+"""
+Shared FASTA / alignment helpers for the pipeline scripts.
+
+read_fasta() and alignment_length() work on plain text; the Alignment class
+keeps an MSA as an (n x L) NumPy uint8 matrix of ASCII codes plus a header
+list, for vectorized column statistics. translate() and back_translate()
+do codon lookups on the same kind of arrays. FastaIndex gives random access
+to large FASTA files through a samtools-compatible .fai index and mmap.
+file_digest() and DigestManifest are the SHA-256 file hashes and JSON
+manifests the scripts use to skip work whose inputs are unchanged.
+"""
+import os
+import mmap
+import hashlib
+import json
+import threading
+
+try:
+    import numpy as np  # only needed for Alignment and the codon helpers
+except ImportError:
+    np = None
+
+GAP = ord('-')
+
+# ==========================================
+# 1. PLAIN FASTA
+# ==========================================
+
+def read_fasta(path):
+    """ Yields (header, sequence) pairs; line wrapping and spaces (Gblocks output) are removed. """
+    header, parts = None, []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(parts)
+                header, parts = line[1:], []
+            elif line and header is not None:
+                parts.append(line.replace(" ", ""))
+    if header is not None:
+        yield header, "".join(parts)
+
+def format_record(header, seq, width=60):
+    """ FASTA text for one record, sequence wrapped at `width` (0 = one line). """
+    if not width:
+        return f">{header}\n{seq}\n"
+    lines = [seq[i:i + width] for i in range(0, len(seq), width)]
+    return f">{header}\n" + "".join(line + "\n" for line in lines)
+
+def alignment_length(path):
+    """ Length of the first sequence (gaps included); only that record is read. """
+    for _, seq in read_fasta(path):
+        return len(seq)
+    return 0
+
+# ==========================================
+# 2. CODONS (standard genetic code)
+# ==========================================
+_BASES = "TCAG"
+_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+
+_CODON_TABLES = None
+_COMPLEMENT = str.maketrans("ACGTUNacgtun", "TGCAANtgcaan")
+
+def reverse_complement(seq):
+    """ Reverse complement of a DNA string; other characters (IUPAC codes, gaps) are kept as is. """
+    return seq.translate(_COMPLEMENT)[::-1]
+
+def _codon_tables():
+    """ (base -> 0..3 code, codon index -> amino acid) lookup arrays, built once. """
+    global _CODON_TABLES
+    if _CODON_TABLES is not None:
+        return _CODON_TABLES
+    base_code = np.full(256, 4, dtype=np.uint8)  # 4 = not A/C/G/T/U
+    for i, base in enumerate(_BASES):
+        base_code[ord(base)] = base_code[ord(base.lower())] = i
+    base_code[ord('U')] = base_code[ord('u')] = 0
+    amino = np.frombuffer((_AMINO_ACIDS + "X").encode('ascii'), dtype=np.uint8)  # index 64 = X
+    _CODON_TABLES = (base_code, amino)
+    return _CODON_TABLES
+
+def codon_indices(codons):
+    """ (n x 3) uint8 codon array -> index 0..63 into the genetic code, 64 for ambiguous codons. """
+    codes = _codon_tables()[0][codons]
+    index = codes[:, 0].astype(np.int64) * 16 + codes[:, 1] * 4 + codes[:, 2]
+    index[(codes == 4).any(axis=1)] = 64
+    return index
+
+def is_stop_codon(codons):
+    """ Boolean per row of an (n x 3) uint8 codon array: TAA, TAG or TGA. """
+    return _codon_tables()[1][codon_indices(codons)] == ord('*')
+
+def translate(seqs):
+    """
+    Translates CDS strings with a single vectorized codon lookup.
+    Trailing incomplete codons are ignored; ambiguous codons become X.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for alignment.translate")
+    n_codons = [len(seq) // 3 for seq in seqs]
+    joined = "".join(seq[:3 * n] for seq, n in zip(seqs, n_codons)).encode('ascii')
+    codons = np.frombuffer(joined, dtype=np.uint8).reshape(-1, 3)
+    protein = _codon_tables()[1][codon_indices(codons)].tobytes().decode('ascii')
+    ends = np.cumsum(n_codons)
+    return [protein[end - n:end] for n, end in zip(n_codons, ends)]
+
+def back_translate(aligned_protein, cds):
+    """ Threads the codons of `cds` onto an aligned protein: residue -> its codon, '-' -> '---'. """
+    protein = np.frombuffer(aligned_protein.encode('ascii'), dtype=np.uint8)
+    residues = protein != GAP
+    n_residues = int(residues.sum())
+    if 3 * n_residues > len(cds):
+        raise ValueError(f"Aligned protein has {n_residues} residues but the CDS only {len(cds) // 3} codons")
+    codons = np.frombuffer(cds[:3 * n_residues].encode('ascii'), dtype=np.uint8).reshape(-1, 3)
+    out = np.full((len(protein), 3), GAP, dtype=np.uint8)
+    out[residues] = codons
+    return out.tobytes().decode('ascii')
+
+# ==========================================
+# 3. ALIGNMENT MATRIX
+# ==========================================
+
+class Alignment:
+    """
+    Multiple sequence alignment: headers[i] names row i of `matrix`,
+    an (n_seqs x length) uint8 array of ASCII characters.
+    """
+    def __init__(self, headers, matrix):
+        if np is None:
+            raise ImportError("NumPy is required for alignment.Alignment")
+        if matrix.shape[0] != len(headers):
+            raise ValueError("Header count does not match the number of rows")
+        self.headers = list(headers)
+        self.matrix = matrix
+
+    @classmethod
+    def from_records(cls, records, name="alignment"):
+        """ Builds from (header, sequence) pairs; raises ValueError if lengths differ. """
+        if np is None:
+            raise ImportError("NumPy is required for alignment.Alignment")
+        records = list(records)
+        headers = [h for h, _ in records]
+        seqs = [seq for _, seq in records]
+        if not seqs:
+            return cls([], np.zeros((0, 0), dtype=np.uint8))
+        if len(set(map(len, seqs))) != 1:
+            raise ValueError(f"{name}: sequences have different lengths")
+        matrix = np.frombuffer("".join(seqs).encode('ascii'), dtype=np.uint8)
+        return cls(headers, matrix.reshape(len(seqs), len(seqs[0])).copy())
+
+    @classmethod
+    def from_fasta(cls, path):
+        return cls.from_records(read_fasta(path), name=os.path.basename(path))
+
+    @property
+    def n_seqs(self):
+        return self.matrix.shape[0]
+
+    @property
+    def length(self):
+        return self.matrix.shape[1]
+
+    def sequence(self, i):
+        return self.matrix[i].tobytes().decode('ascii')
+
+    def records(self):
+        for i, header in enumerate(self.headers):
+            yield header, self.sequence(i)
+
+    # --- Column statistics ---
+    def upper(self):
+        """ Matrix with lowercase letters (MAFFT output) folded to uppercase. """
+        m = self.matrix
+        return np.where((m >= 97) & (m <= 122), m - 32, m).astype(np.uint8)
+
+    def gap_counts(self):
+        return (self.matrix == GAP).sum(axis=0)
+
+    def gap_fraction(self):
+        return self.gap_counts() / max(self.n_seqs, 1)
+
+    def residue_counts(self):
+        """ Per column: how many sequences share the most common (non-gap) residue. """
+        upper = self.upper()
+        best = np.zeros(self.length, dtype=np.int64)
+        for symbol in np.unique(upper):
+            if symbol != GAP:
+                np.maximum(best, (upper == symbol).sum(axis=0), out=best)
+        return best
+
+    def conservation(self):
+        """ Fraction of sequences sharing the most common residue, per column. """
+        return self.residue_counts() / max(self.n_seqs, 1)
+
+    # --- Column selection ---
+    def select_columns(self, columns):
+        """ New Alignment with the given columns (bool mask or index array). """
+        return Alignment(self.headers, self.matrix[:, columns])
+
+    def codon_position(self, position):
+        """ Columns of codon position 1, 2 or 3. """
+        return self.select_columns(np.arange(position - 1, self.length, 3))
+
+    # --- Output ---
+    def write_fasta(self, path, width=60):
+        with open(path, 'w') as f:
+            for header, seq in self.records():
+                f.write(format_record(header, seq, width))
+
+# ==========================================
+# 4. INDEXED FASTA (samtools .fai + mmap)
+# ==========================================
+
+class FastaIndex:
+    """
+    Random access to a (large) FASTA file without loading it. The index is
+    samtools faidx-compatible (NAME, LENGTH, OFFSET, LINEBASES, LINEWIDTH),
+    built once next to the FASTA (or in `fallback_dir` if that location is
+    read-only) and reused while it is newer than the FASTA. Sequences are
+    sliced out of an mmap of the file. Supports `name in index`,
+    `index[name]`, len() and fetch(name, start, end).
+    """
+    def __init__(self, fasta_path, index_path=None, fallback_dir="."):
+        self.fasta_path = fasta_path
+        self.index_path = index_path or fasta_path + ".fai"
+        self.entries = {}  # name -> (length, offset, linebases, linewidth)
+
+        candidates = [self.index_path]
+        if index_path is None:
+            candidates.append(os.path.join(fallback_dir, os.path.basename(fasta_path) + ".fai"))
+        for candidate in candidates:
+            if self._is_fresh(candidate):
+                self.index_path = candidate
+                self._read_index()
+                break
+        else:
+            self.entries = self.build(fasta_path)
+            for candidate in candidates:
+                try:
+                    self._write_index(candidate)
+                    self.index_path = candidate
+                    break
+                except OSError:
+                    continue
+
+        self._file = open(fasta_path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def _is_fresh(self, path):
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.fasta_path)
+
+    @staticmethod
+    def build(fasta_path):
+        """ One sequential pass; raises ValueError if a record's lines are unevenly wrapped. """
+        entries = {}
+        name = None
+
+        def finish():
+            # Like samtools, empty records are left out of the index
+            if name is not None and length:
+                entries[name] = (length, seq_offset, linebases or 0, linewidth or 0)
+
+        offset = 0
+        with open(fasta_path, 'rb') as f:
+            for line in f:
+                if line.startswith(b">"):
+                    finish()
+                    fields = line[1:].split(None, 1)
+                    name = fields[0].decode() if fields else ""
+                    seq_offset = offset + len(line)
+                    length, linebases, linewidth, short_line = 0, None, None, False
+                elif name is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if linebases is None:
+                        linebases, linewidth = bases, len(line)
+                    elif (short_line and bases) or bases > linebases:
+                        raise ValueError(f"{os.path.basename(fasta_path)}: '{name}' has lines of different "
+                                         f"lengths; rewrap the file (e.g. seqkit seq -w 60) to index it")
+                    if bases < linebases:
+                        short_line = True
+                    length += bases
+                offset += len(line)
+        finish()
+        return entries
+
+    def _write_index(self, path):
+        tmp = path + ".part"
+        with open(tmp, 'w') as f:
+            for name, (length, offset, linebases, linewidth) in self.entries.items():
+                f.write(f"{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n")
+        os.replace(tmp, path)
+
+    def _read_index(self):
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) >= 5:
+                    self.entries[fields[0]] = tuple(int(x) for x in fields[1:5])
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def total_length(self):
+        """ Residues in the indexed FASTA (sum of sequence lengths). """
+        return sum(entry[0] for entry in self.entries.values())
+
+    def __getitem__(self, name):
+        return self.fetch(name)
+
+    def fetch(self, name, start=0, end=None):
+        """ Sequence `name`, 0-based half-open [start, end). """
+        length, offset, linebases, linewidth = self.entries[name]
+        end = length if end is None else min(end, length)
+        start = max(start, 0)
+        if start >= end:
+            return ""
+
+        def byte_pos(i):
+            return offset + (i // linebases) * linewidth + i % linebases
+
+        raw = self._map[byte_pos(start):byte_pos(end - 1) + 1]
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode('ascii')
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+# ==========================================
+# 5. FILE DIGESTS AND MANIFESTS
+# ==========================================
+
+def file_digest(path):
+    """ SHA-256 hex digest of a file's bytes, read in 1 MB blocks. """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class DigestManifest:
+    """
+    JSON manifest of name -> (job key, digest of the file the job wrote).
+    A job is fresh while its key (inputs, tool version, parameters) and its
+    output file are unchanged since it was recorded. Names default to the
+    normalized output path. Thread-safe; rewritten atomically on every record.
+    """
+    def __init__(self, manifest_path, enabled=True):
+        self.path = manifest_path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = {}
+        if enabled and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"[!] Ignoring unreadable cache manifest {manifest_path}")
+
+    @staticmethod
+    def make_key(*parts):
+        """ SHA-256 of the JSON-encoded parts. """
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def is_fresh(self, output_path, key, name=None):
+        if not self.enabled or key is None or not os.path.exists(output_path):
+            return False
+        with self.lock:
+            entry = self.entries.get(name or os.path.normpath(output_path))
+        return bool(entry) and entry.get("key") == key and entry.get("output") == file_digest(output_path)
+
+    def record(self, output_path, key, name=None):
+        if not self.enabled or key is None:
+            return
+        entry = {"key": key, "output": file_digest(output_path)}
+        with self.lock:
+            self.entries[name or os.path.normpath(output_path)] = entry
+            tmp = self.path + ".part"
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the download scripts against mock_ensembl_server.py.
+
+For every scenario and gene-list size it runs the script in a fresh temp
+directory and reports wall time, requests per gene and throughput.
+Scenarios override module settings (BATCH_LOOKUPS, FETCH_MODE, ...) before
+calling the script's main(), so they can be compared on the same mock data.
+
+Usage: python3 benchmark_downloads.py [size1,size2,...]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import mock_ensembl_server as mock
+
+# --- CONFIGURATION ---
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+FETCH_SCRIPT = os.path.join(SRC_DIR, "1_fetch_orthologs_2g.py")
+LEGACY_SCRIPT = os.path.join(SRC_DIR, "ens_ortho_cds_down.py")
+PORT = 8799
+GENE_LIST_SIZES = [1, 10, 50]
+MOCK_LATENCY = 0.05
+MOCK_RATE_LIMIT_EVERY = 0   # inject a 429 every N requests to exercise the retry paths
+
+NO_CACHE = {"CACHE_FILE": None}
+SCENARIOS = [
+    # (label, script, module overrides)
+    ("fetch serial, per-protein", FETCH_SCRIPT, {**NO_CACHE, "BATCH_LOOKUPS": False, "TARGET_TAXA": []}),
+    ("fetch serial, batched", FETCH_SCRIPT, {**NO_CACHE}),
+    ("fetch async, batched", FETCH_SCRIPT, {**NO_CACHE, "FETCH_MODE": "async"}),
+    ("fetch async, full homology", FETCH_SCRIPT, {**NO_CACHE, "FETCH_MODE": "async", "HOMOLOGY_MODE": "full"}),
+    ("legacy ens_ortho_cds_down", LEGACY_SCRIPT, {}),
+]
+
+# Loads a script by path, applies overrides and runs its main() with a gene list
+RUNNER = """
+import importlib.util, json, os, sys
+path, overrides, genes = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3]
+sys.path.insert(0, os.path.dirname(os.path.abspath(path)))  # as when the script is run directly (alignment.py)
+spec = importlib.util.spec_from_file_location("bench_target", path)
+mod = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mod)
+for name, value in overrides.items():
+    setattr(mod, name, value)
+if hasattr(mod, "RateLimiter"):
+    mod.RATE_LIMITER = mod.RateLimiter(mod.MAX_REQUESTS_PER_SECOND)
+sys.argv = [path, genes]
+mod.main()
+"""
+
+def mock_call(path, method="GET"):
+    req = urllib.request.Request(f"http://127.0.0.1:{PORT}{path}", method=method,
+                                 data=b"{}" if method == "POST" else None)
+    with urllib.request.urlopen(req) as r:
+        return json.loads(r.read())
+
+def run_scenario(script, overrides, n_genes):
+    """Runs one script on n_genes synthetic gene IDs; returns (seconds, mock stats, ok)."""
+    with tempfile.TemporaryDirectory() as workdir:
+        gene_file = os.path.join(workdir, "genes.txt")
+        with open(gene_file, 'w') as f:
+            for i in range(n_genes):
+                f.write(f"ENSG{i + 1:011d}\n")
+
+        env = dict(os.environ, ENSEMBL_REST_SERVER=f"http://127.0.0.1:{PORT}")
+        mock_call("/__reset__", method="POST")
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", RUNNER, script, json.dumps(overrides), gene_file],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0:
+            print(proc.stderr[-2000:])
+        return elapsed, mock_call("/__stats__"), proc.returncode == 0
+
+def main():
+    sizes = [int(x) for x in sys.argv[1].split(",")] if len(sys.argv) > 1 else GENE_LIST_SIZES
+
+    mock.LATENCY = MOCK_LATENCY
+    mock.RATE_LIMIT_EVERY = MOCK_RATE_LIMIT_EVERY
+    server = mock.start_server(PORT)
+    print(f"Mock server on port {PORT} ({MOCK_LATENCY * 1000:.0f} ms latency, "
+          f"{mock.ORTHOLOGS_PER_GENE} orthologs/gene)")
+    print("-" * 88)
+    print(f"{'scenario':<30}{'genes':>6}{'wall s':>9}{'requests':>10}{'req/gene':>10}{'genes/s':>9}{'429s':>6}  status")
+
+    try:
+        for label, script, overrides in SCENARIOS:
+            for n in sizes:
+                elapsed, stats, ok = run_scenario(script, overrides, n)
+                print(f"{label:<30}{n:>6}{elapsed:>9.2f}{stats['requests']:>10}"
+                      f"{stats['requests'] / n:>10.1f}{n / elapsed:>9.2f}{stats['injected_429']:>6}  "
+                      f"{'ok' if ok else 'FAILED'}")
+    finally:
+        server.shutdown()
+    print("-" * 88)
+
+if __name__ == "__main__":
+    main()
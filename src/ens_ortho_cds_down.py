@@ -3,135 +3,190 @@
 import requests, sys
 import time
 import xml.etree.ElementTree as ET
-import pandas as pd
-import os, glob, shutil
+import csv, io
+import os, shutil
 
 #a script to download cds of a given human geneid using the ENSEMBL REST APIs
 #my previous preferred way to download cds was (see here: https://pmc.ncbi.nlm.nih.gov/articles/PMC3855309/) using the EASER script, which used PyCogent,
 #which is now not developed and has been modified to cogent3 and EnsemblLite (ensembl-tui or eti)
-#this script can be modified for every use case in the rest.ensembl.org and download anything the user likes 
+#this script can be modified for every use case in the rest.ensembl.org and download anything the user likes
 #usage python3 ensid.py name_of_the_text_file_with_ensemble_ids_one_id_per_line.txt
+#
+#every gene is handled in memory: the homology XML is parsed while it streams in,
+#transcripts and cds are kept in dicts, and the outputs are written once at the end
+#into <OUTPUT_ROOT>/<ensid>/ (the working directory is never changed)
+#a gene hit by a network or server error gets no folder, so the next run retries it
+
+# --- CONFIGURATION ---
+SERVER = os.environ.get("ENSEMBL_REST_SERVER", "https://rest.ensembl.org")
+OUTPUT_ROOT = "."                  # one folder per gene id is created here
+TAXONOMY_LEVEL = 'Euteleostomi'    # selecting only fishes
+# False: <ensid>/concatenated_fasta.fasta + euteleostomi_orthologues.csv only
+# True:  also the old layout: <ensid>.xml, output.csv, jsons/*.json, fasta_cds/*.fasta
+LEGACY_LAYOUT = False
+RETRIES = 5
+
+SESSION = requests.Session()#one keep-alive connection for every request
+
 #definitions to download from restapi given below=============
-def download_seqids_ensembl_restapi(ext_master):    
-    server = "https://rest.ensembl.org"
-    #ext_master
-    ext=ext_master
-    try:
-        r = requests.get(server+ext, headers={ "Content-Type" : "text/xml"},timeout=60)
-        file.write(r.text)
-    except requests.exceptions.RequestException as e:
-        print(e)
-#downloading all ortholog information to xml file using the above function ===========================================================================
-#getting transcript information as jsons
-def download_transcript_ensembl_restapi(gid):
-    server = "https://rest.ensembl.org"
-    ext = '/overlap/translation/'+otd+'?'
-    #print(server+ext)
-    try:
-        rs = requests.get(server+ext, headers={ "Content-Type" : "application/json"},timeout=60)
-        file.write(rs.text)
-    except requests.exceptions.RequestException as e:
-        print(e)
+def rest_get(ext, content_type, stream=False):
+    #GET with a few retries; honours Retry-After when the server rate limits us (HTTP 429)
+    #and backs off on network and server (5xx) errors; returns None if every attempt failed
+    for attempt in range(RETRIES):
+        try:
+            r = SESSION.get(SERVER+ext, headers={ "Content-Type" : content_type}, timeout=60, stream=stream)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            time.sleep(2 ** attempt)
+            continue
+        if r.status_code == 429:
+            time.sleep(float(r.headers.get("Retry-After", 1)))
+            continue
+        if r.status_code >= 500:
+            print(f"{SERVER+ext}: HTTP {r.status_code}")
+            r.close()
+            time.sleep(2 ** attempt)
+            continue
+        return r
+    return None
+
+class DownloadError(Exception):
+    #the server could not be reached: unlike a 4xx answer this does not mean "not found"
+    pass
+
+class TeeReader:
+    #file-like wrapper that keeps a copy of everything read (to save the xml in the legacy layout)
+    def __init__(self, raw, sink):
+        self.raw = raw
+        self.sink = sink
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.sink.write(data)
+        return data
+
+def stream_orthologues(ensid, xml_copy=None):
+    #downloading all ortholog information as xml and parsing it while it streams in
+    #returns None if the download fails (also halfway through the stream)
+    ext = '/homology/id/human/'+ensid+'?'+'type=orthologues;format=condensed'#"/homology/id/human/ENSG00000157764?type=orthologues;format=condensed"
+    r = rest_get(ext, "text/xml", stream=True)
+    if r is None or not r.ok:
+        print(f"Could not download orthologues for {ensid}")
+        return None
+    r.raw.decode_content = True
+    source = TeeReader(r.raw, xml_copy) if xml_copy is not None else r.raw
+    rows = []
+    with r:
+        try:
+            for event, elem in ET.iterparse(source, events=("end",)):
+                if elem.tag == 'homologies':
+                    rows.append({"id": elem.attrib['id'], "species": elem.attrib['species'], "type": elem.attrib['type'],
+                                 "pid": elem.attrib['protein_id'], "taxonomy_level": elem.attrib['taxonomy_level']})
+                    elem.clear()
+        except (ET.ParseError, requests.exceptions.RequestException, OSError) as e:
+            print(f"Could not download orthologues for {ensid}: {e}")
+            return None
+    return rows
+
+#getting transcript information as json
+def download_transcript_ensembl_restapi(pid):
+    ext = '/overlap/translation/'+pid+'?'
+    r = rest_get(ext, "application/json")
+    if r is None:
+        raise DownloadError(f"no answer for {ext}")
+    if not r.ok:
+        return None, None
+    data = r.json()
+    tsc = data[0]['Parent'] if data else None#only pid has parent transcript see https://www.biostars.org/p/105773/
+    return tsc, r.text
+
 #download cds sequences in fasta format
-def download_seqs_ensembl_restapi(tsc):
-    server = "https://rest.ensembl.org"
+def download_seqs_ensembl_restapi(transcript_id):
     ext = '/sequence/id/'+transcript_id+'?type=cds'
-    #print(server+ext)
+    r = rest_get(ext, "text/x-fasta")
+    if r is None:
+        raise DownloadError(f"no answer for {ext}")
+    if not r.ok:
+        return None
+    return r.text
+
+def write_indexed_csv(path, indexed_rows, cols):
+    #writes rows the way DataFrame.to_csv() did: an unnamed index column first
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out, lineterminator=os.linesep)
+        writer.writerow([''] + cols)
+        for idx, row in indexed_rows:
+            writer.writerow([idx] + [row[c] for c in cols])
+
+def process_gene(ensid, legacy_layout=LEGACY_LAYOUT):
+    #download everything for one gene in memory, then write the outputs once
+    gene_dir = os.path.join(OUTPUT_ROOT, ensid)
+    xml_copy = io.BytesIO() if legacy_layout else None
+
+    cols = ["id", "species", "type", "pid", "taxonomy_level"]
+    rows = stream_orthologues(ensid, xml_copy)
+    if rows is None:
+        #no <ensid>/ folder is written, so the gene is retried on the next run
+        return None
+    fish_rows = [(i, row) for i, row in enumerate(rows) if row['taxonomy_level']==TAXONOMY_LEVEL]
+#fish_rows = [... if row['taxonomy_level'] in ('Euteleostomi', 'Sarcopterygii')] # if we need latimeria, and 'Vertebrata' to get hag fish and petromyzon
+
+    jsons = {}   # pid -> raw json text
+    fastas = {}  # transcript id -> fasta text (a transcript shared by two rows is kept once)
     try:
-        rs = requests.get(server+ext, headers={ "Content-Type" : "text/x-fasta"},timeout=60)
-        file.write(rs.text)
-    except requests.exceptions.RequestException as e:
-        print(e)
+        for i, row in fish_rows:
+            pid = str(row['pid'])
+            tsc, json_text = download_transcript_ensembl_restapi(pid)
+            if json_text is not None:
+                jsons[pid] = json_text
+            if tsc is None or tsc in fastas:
+                continue
+            fasta_text = download_seqs_ensembl_restapi(tsc)
+            if fasta_text is not None:
+                fastas[tsc] = fasta_text
+    except DownloadError as e:
+        print(f"Could not download {ensid}: {e}")
+        return None
+
+    # Writing the outputs ==========================================================
+    #written into <ensid>.part/ and renamed at the end, so an interrupted run leaves no <ensid>/ behind
+    final_dir = gene_dir
+    gene_dir = final_dir + ".part"
+    shutil.rmtree(gene_dir, ignore_errors=True)
+    os.makedirs(gene_dir)
+    write_indexed_csv(os.path.join(gene_dir, 'euteleostomi_orthologues.csv'), fish_rows, cols)
+    with open(os.path.join(gene_dir, "concatenated_fasta.fasta"), "w") as outfile:
+        outfile.write("".join(fastas.values()))
+
+    if legacy_layout:
+        with open(os.path.join(gene_dir, ensid+'.xml'), 'wb') as f:
+            f.write(xml_copy.getvalue())
+        write_indexed_csv(os.path.join(gene_dir, 'output.csv'), enumerate(rows), cols)
+        for folder, files in (("jsons", {pid+'.json': text for pid, text in jsons.items()}),
+                              ("fasta_cds", {tsc+'.fasta': text for tsc, text in fastas.items()})):
+            os.makedirs(os.path.join(gene_dir, folder), exist_ok=True)
+            for name, text in files.items():
+                with open(os.path.join(gene_dir, folder, name), 'w') as f:
+                    f.write(text)
+    if os.path.isdir(final_dir):
+        shutil.rmtree(final_dir)
+    os.rename(gene_dir, final_dir)
+
+    print(f"{ensid}: {len(fish_rows)} {TAXONOMY_LEVEL} orthologues, {len(fastas)} cds sequences")
+    return len(fastas)
+
 #starting the script=========
-masterdir=os.getcwd()#declaring the working directory
-ensid_file = sys.argv[1]#the argument takes the file to read
-with open(ensid_file, "r") as enfil:
-    #ensid_list=[]#we open a list to store all the ensembl ids that we work with, intended to exit the for loop gracefully
-    ensid_list = os.listdir()
-    #ensid_list.append(dir_list)
-    #print(ensid_list)
-    for line in enfil:
-        linestripped=line.splitlines()
-        ensid=linestripped[0]
-        #print(ensid)
-        if ensid in ensid_list:
-            pass
-        elif ensid not in ensid_list:
-            ensid_list.append(ensid)
-           #print(ensid_list)
-            os.makedirs(ensid)
-            chdir=masterdir+'/'+ensid
-            os.chdir(chdir)
-            fn=ensid+'.xml'
-        #print(fn)
-            search_id = str(ensid)
-            ext_master = '/homology/id/human/'+search_id+'?'+'type=orthologues;format=condensed'#"/homology/id/human/ENSG00000157764?type=orthologues;format=condensed"
-            with open(fn, 'w') as file:
-                download_seqids_ensembl_restapi(ext_master)
-            time.sleep(5) 
-# Parsing the XML file=========================================================================================
-
-            cols = ["id", "species", "type", "pid", "taxonomy_level"]
-            rows = []
-            tree = ET.parse(fn)
-            root = tree.getroot()
-            speciesl = []
-            gidl = []
-            pidl = []
-            opl = []
-            for child in tree.iter('homologies'):
-                spp = child.attrib['species']
-                gid = child.attrib['id']
-                pid = child.attrib['protein_id']
-                op = child.attrib['type']
-                taxonomy_level = child.attrib['taxonomy_level']
-                rows.append({"id": gid,"species": spp,"type": op,"pid": pid,"taxonomy_level": taxonomy_level})
-
-            df = pd.DataFrame(rows, columns=cols)
-# Writing dataframe to csv
-            df.to_csv('output.csv')
-            ndf = df[df['taxonomy_level']=='Euteleostomi']#selecting only fishes
-#ndf = df[(df['taxonomy_level']=='Euteleostomi') & (df['taxonomy_level']=='Sarcopterygii')] # if we need latimeria can add & to get hag fish and petromyzon using 'vertebrata'
-            ndf.to_csv('euteleostomi_orthologues.csv')
-#Downloading json files for eveny pids to extract Parent===============================================================================
-            dfe = pd.read_csv('euteleostomi_orthologues.csv')
-            for gid in dfe['pid']:#only pid has parent transcript see https://www.biostars.org/p/105773/ which we collect below as tsc
-    #print(gid)&spp in dfe['species']
-                otd = str(gid)
-                fln = otd+'.json'
-                fln_fasta = otd+'.fasta'
-    #server = "https://rest.ensembl.org"
-                with open(fln, 'w') as file:
-                    download_transcript_ensembl_restapi(gid)
-    #time.sleep(5)
-                data_df = pd.read_json(fln) #reading the json file here
-                tsc = data_df['Parent'].iloc[0]#extracting the transcript id here
-    #print(tsc)
-                transcript_id = str(tsc)
-                fastaname = transcript_id+'.fasta'
-                with open(fastaname,'w') as file:
-                    download_seqs_ensembl_restapi(transcript_id)
-            if not os.path.exists("jsons"):#creating a folder to store all json files
-                os.makedirs("jsons")
-            if not os.path.exists("fasta_cds"):#creating a folder to store all fasta files
-                os.makedirs("fasta_cds")
-            curr_dir = os.getcwd()#what is the current directory
-            files = glob.iglob(os.path.join(curr_dir, "*.json"))#make a list of all json files in this directory
-            fastas = glob.iglob(os.path.join(curr_dir, "*.fasta"))#make a list of all fasta files in this directory
-            paths = os.path.abspath(os.getcwd())#getting the path of the current directory to create a path for all json and fasta files to be copied in the next commands
-            path_json = paths+"/jsons"
-            path_fasta = paths+"/fasta_cds"
-            for file in files:#let's move all json file to the cerated 'jsons' directory
-                if os.path.isfile(file):
-                    shutil.move(file, path_json)
-            for fasta_file in fastas:#Let's move all the fasta files to the created fasta_cds directory
-                if os.path.isfile(fasta_file):
-                    shutil.move(fasta_file, path_fasta)
-            path_fasta_files = path_fasta+"/*.fasta"
-            fasta_files = glob.glob(path_fasta_files)
-            with open("concatenated_fasta.fasta", "wb") as outfile:#now we are going to concatenate the fasta files in the fasta_cds directory to a concatenated_fasta.fasta file
-                for filename in fasta_files:
-                    with open(filename,"rb") as infile:
-                        shutil.copyfileobj(infile,outfile)
-            os.chdir(masterdir)
+def main():
+    ensid_file = sys.argv[1]#the argument takes the file to read
+    existing = set(os.listdir(OUTPUT_ROOT))#genes already downloaded (a folder with their name exists) are skipped
+    with open(ensid_file, "r") as enfil:
+        for line in enfil:
+            linestripped=line.splitlines()
+            ensid=linestripped[0].strip()
+            if not ensid or ensid in existing:
+                continue
+            existing.add(ensid)
+            process_gene(ensid)
 #print("Orthologs for these human ensembl gene ids were downloaded: "+ensid_list)
+
+if __name__ == "__main__":
+    main()
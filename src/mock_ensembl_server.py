@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for rest.ensembl.org, for testing and benchmarking the fetch
+scripts without touching the real service.
+
+Serves synthetic (or recorded) responses for the endpoints the pipeline uses:
+  GET  /info/data
+  GET  /homology/id/human/<gene>   (condensed / full JSON, condensed XML)
+  GET  /overlap/translation/<protein>
+  GET  /sequence/id/<id>           (JSON or FASTA)
+  GET  /lookup/id/<id>,  POST /lookup/id
+  POST /sequence/id
+plus /__stats__ (request counts) and POST /__reset__.
+
+Latency, 429 injection (with Retry-After) and X-RateLimit-* headers are
+configurable.
+
+Usage: python3 mock_ensembl_server.py [port]
+Then:  ENSEMBL_REST_SERVER=http://127.0.0.1:<port> python3 1_fetch_orthologs_2g.py genes.txt
+"""
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import quoteattr
+
+# --- CONFIGURATION ---
+PORT = 8765
+RELEASE = 113
+LATENCY = 0.05            # Seconds added to every request
+LATENCY_JITTER = 0.02     # +/- uniform jitter
+RATE_LIMIT_EVERY = 0      # Answer every Nth request with HTTP 429 (0 = never)
+RETRY_AFTER = 1           # Retry-After header sent with injected 429s
+RATE_LIMIT_WINDOW = 55000 # X-RateLimit-Limit per RATE_LIMIT_PERIOD seconds
+RATE_LIMIT_PERIOD = 3600
+ORTHOLOGS_PER_GENE = 40   # Synthetic orthologs per human gene (all species)
+FAMILY_SIZE = 1           # Genes i and j share orthologs if i // FAMILY_SIZE == j // FAMILY_SIZE
+RECORDINGS_FILE = None    # JSONL of recorded responses, served before synthetic ones
+
+# Target species of the synthetic homologies:
+# (species, taxonomy_level of the split from human, NCBI clade for target_taxon)
+SPECIES = [
+    ("danio_rerio",          "Euteleostomi",     7898),
+    ("oryzias_latipes",      "Euteleostomi",     7898),
+    ("gasterosteus_aculeatus", "Euteleostomi",   7898),
+    ("lepisosteus_oculatus", "Euteleostomi",     7898),
+    ("latimeria_chalumnae",  "Sarcopterygii",    118072),
+    ("callorhinchus_milii",  "Gnathostomata",    7777),
+    ("petromyzon_marinus",   "Vertebrata",       1476529),
+    ("mus_musculus",         "Euarchontoglires", 40674),
+    ("bos_taurus",           "Boreoeutheria",    40674),
+    ("gallus_gallus",        "Amniota",          8782),
+    ("anolis_carolinensis",  "Amniota",          8504),
+    ("xenopus_tropicalis",   "Tetrapoda",        8364),
+]
+
+# ==========================================
+# 1. SYNTHETIC DATA
+# ==========================================
+
+def stable_number(text, modulo=10 ** 11):
+    return zlib.crc32(text.encode()) % modulo
+
+def synthetic_homologies(gene_id):
+    """Deterministic ortholog list for a human gene ID."""
+    digits = re.sub(r"\D", "", gene_id) or str(stable_number(gene_id))
+    family = int(digits) // FAMILY_SIZE
+    homologies = []
+    for k in range(ORTHOLOGS_PER_GENE):
+        species, level, taxon = SPECIES[k % len(SPECIES)]
+        code = species[:3].upper()
+        number = stable_number(f"{family}:{k}")
+        homologies.append({
+            "species": species,
+            "taxonomy_level": level,
+            "taxon": taxon,
+            "type": "ortholog_one2one" if k < len(SPECIES) else "ortholog_one2many",
+            "id": f"ENS{code}G{number:011d}",
+            "protein_id": f"ENS{code}P{number:011d}",
+        })
+    return homologies
+
+def transcript_of(protein_id):
+    return protein_id.replace("P", "T", 1) if protein_id.startswith("ENS") else None
+
+def synthetic_cds(transcript_id):
+    rng = random.Random(transcript_id)
+    codons = [rng.choice("ACGT") + rng.choice("ACGT") + rng.choice("ACGT") for _ in range(rng.randint(100, 500))]
+    codons = [c if c not in ("TAA", "TAG", "TGA") else "TTA" for c in codons]
+    return "ATG" + "".join(codons) + "TAA"
+
+def gene_symbol(gene_id):
+    return f"GENE{stable_number(gene_id, 100000)}"
+
+# ==========================================
+# 2. SERVER STATE
+# ==========================================
+
+class MockState:
+    """Request counters, 429 injection and the rate-limit window."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recordings = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.by_endpoint = {}
+            self.injected_429 = 0
+            self.window_start = time.time()
+            self.window_used = 0
+
+    def count(self, method, path):
+        """Registers a request; returns True if it should get an injected 429."""
+        key = method + " " + "/".join(path.split("/")[:3])
+        with self.lock:
+            self.requests += 1
+            self.by_endpoint[key] = self.by_endpoint.get(key, 0) + 1
+            if time.time() - self.window_start > RATE_LIMIT_PERIOD:
+                self.window_start, self.window_used = time.time(), 0
+            self.window_used += 1
+            if RATE_LIMIT_EVERY and self.requests % RATE_LIMIT_EVERY == 0:
+                self.injected_429 += 1
+                return True
+        return False
+
+    def rate_headers(self):
+        with self.lock:
+            remaining = max(RATE_LIMIT_WINDOW - self.window_used, 0)
+            reset = max(int(RATE_LIMIT_PERIOD - (time.time() - self.window_start)), 0)
+        return {"X-RateLimit-Limit": str(RATE_LIMIT_WINDOW), "X-RateLimit-Period": str(RATE_LIMIT_PERIOD),
+                "X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset": str(reset)}
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "by_endpoint": dict(self.by_endpoint),
+                    "injected_429": self.injected_429}
+
+    def load_recordings(self, path):
+        """
+        Each JSONL line: {"method", "path" (with query string, or without to
+        match any), "status", "content_type", "body"}.
+        """
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    self.recordings[(rec.get("method", "GET"), rec["path"])] = rec
+
+STATE = MockState()
+
+# ==========================================
+# 3. REQUEST HANDLER
+# ==========================================
+
+class MockEnsemblHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", extra_headers=None):
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in {**STATE.rate_headers(), **(extra_headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wanted_type(self):
+        """Ensembl picks the format from Content-Type (or Accept)."""
+        asked = self.headers.get("Content-Type", "") + " " + self.headers.get("Accept", "")
+        if "xml" in asked:
+            return "xml"
+        if "fasta" in asked:
+            return "fasta"
+        return "json"
+
+    def begin(self, method):
+        """Common bookkeeping; returns False if the request was already answered."""
+        url = urlparse(self.path)
+        if url.path.startswith("/__"):
+            return True
+        if LATENCY:
+            time.sleep(max(0.0, LATENCY + random.uniform(-LATENCY_JITTER, LATENCY_JITTER)))
+        if STATE.count(method, url.path):
+            self.send_body(429, {"error": "Too many requests"}, extra_headers={"Retry-After": str(RETRY_AFTER)})
+            return False
+        rec = STATE.recordings.get((method, self.path)) or STATE.recordings.get((method, url.path))
+        if rec:
+            self.send_body(rec.get("status", 200), rec["body"], rec.get("content_type", "application/json"))
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.begin("GET"):
+            return
+        url = urlparse(self.path)
+        path, query = url.path, parse_qs(url.query.replace(";", "&"))
+        kind = self.wanted_type()
+
+        if path == "/__stats__":
+            return self.send_body(200, STATE.stats())
+        if path == "/info/data":
+            return self.send_body(200, {"releases": [RELEASE]})
+
+        m = re.match(r"^/homology/id/human/([^/]+)$", path)
+        if m:
+            return self.homology(m.group(1), query, kind)
+
+        m = re.match(r"^/overlap/translation/([^/]+)$", path)
+        if m:
+            tid = transcript_of(m.group(1))
+            return self.send_body(200, [{"Parent": tid, "id": m.group(1), "feature_type": "translation"}])
+
+        m = re.match(r"^/sequence/id/([^/]+)$", path)
+        if m:
+            seq_id = m.group(1)
+            seq = synthetic_cds(seq_id)
+            if kind == "fasta":
+                lines = [seq[i:i + 60] for i in range(0, len(seq), 60)]
+                return self.send_body(200, f">{seq_id}\n" + "\n".join(lines) + "\n", "text/x-fasta")
+            return self.send_body(200, {"id": seq_id, "seq": seq, "molecule": "dna"})
+
+        m = re.match(r"^/lookup/id/([^/]+)$", path)
+        if m:
+            return self.send_body(200, self.lookup(m.group(1)))
+
+        self.send_body(404, {"error": f"Unknown endpoint {path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if urlparse(self.path).path == "/__reset__":
+            STATE.reset()
+            return self.send_body(200, {"reset": True})
+        if not self.begin("POST"):
+            return
+        path = urlparse(self.path).path
+        ids = payload.get("ids", [])
+
+        if path == "/lookup/id":
+            return self.send_body(200, {i: self.lookup(i) for i in ids})
+        if path == "/sequence/id":
+            return self.send_body(200, [{"query": i, "id": i, "seq": synthetic_cds(i), "molecule": "dna"} for i in ids])
+        self.send_body(404, {"error": f"Unknown endpoint {path}"})
+
+    @staticmethod
+    def lookup(stable_id):
+        if stable_id[3:].startswith("P") or re.match(r"^ENS[A-Z]{3}P", stable_id):
+            return {"id": stable_id, "object_type": "Translation", "Parent": transcript_of(stable_id)}
+        return {"id": stable_id, "object_type": "Gene", "display_name": gene_symbol(stable_id)}
+
+    def homology(self, gene_id, query, kind):
+        homologies = synthetic_homologies(gene_id)
+        taxa = {int(t) for t in query.get("target_taxon", [])}
+        species = set(query.get("target_species", []))
+        if taxa or species:
+            homologies = [h for h in homologies if h["taxon"] in taxa or h["species"] in species]
+
+        if kind == "xml":
+            items = "".join(
+                f"<homologies id={quoteattr(h['id'])} protein_id={quoteattr(h['protein_id'])} "
+                f"species={quoteattr(h['species'])} taxonomy_level={quoteattr(h['taxonomy_level'])} "
+                f"type={quoteattr(h['type'])} />"
+                for h in homologies
+            )
+            return self.send_body(200, f"<opt><data id={quoteattr(gene_id)}>{items}</data></opt>", "text/xml")
+
+        if query.get("format", ["condensed"])[0] == "full":
+            entries = [{
+                "type": h["type"], "taxonomy_level": h["taxonomy_level"], "method_link_type": "ENSEMBL_ORTHOLOGUES",
+                "source": {"id": gene_id, "species": "homo_sapiens"},
+                "target": {"id": h["id"], "protein_id": h["protein_id"], "species": h["species"],
+                           "align_seq": synthetic_cds(transcript_of(h["protein_id"]))},
+            } for h in homologies]
+        else:
+            entries = [{k: h[k] for k in ("species", "taxonomy_level", "type", "id", "protein_id")} for h in homologies]
+        self.send_body(200, {"data": [{"id": gene_id, "homologies": entries}]})
+
+# ==========================================
+# 4. ENTRY POINTS
+# ==========================================
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is normal; anything else is reported
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+def start_server(port=PORT):
+    """Starts the mock in a background thread; returns the server (call .shutdown())."""
+    if RECORDINGS_FILE:
+        STATE.load_recordings(RECORDINGS_FILE)
+    server = MockServer(("127.0.0.1", port), MockEnsemblHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    server = start_server(port)
+    print(f"Mock Ensembl REST server on http://127.0.0.1:{port} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()